@@ -1,22 +1,52 @@
 from __future__ import annotations
 
-from fastapi import FastAPI
+import hmac
+import os
+import sys
+import threading
+import time
+
+from fastapi import Depends, FastAPI, Header, HTTPException, Request, Response
+from fastapi.responses import FileResponse, JSONResponse
 from pydantic import BaseModel, Field
-from typing import Any, Dict, List, Optional
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
 
+from rag.admission import Deadline, Overloaded, request_gate
 from rag.config import settings
-from rag.service import RAGService
+from rag.metrics import metrics
+from rag.profiling import MODES, Capture, list_profiles, profile, profile_file, sampled_mode
+from rag.retrievers.filter_index import FilterError
+from rag.utils import memory_usage_mb
+
+if TYPE_CHECKING:
+    from rag.service import RAGService
 
 app = FastAPI(title="Data Platform RAG Troubleshooting Assistant", version="1.0.0")
 
-svc: Optional[RAGService] = None
+# rag.service (models, FAISS, langchain) is imported by the loader thread, not here,
+# so uvicorn can bind the port before any of it is loaded.
+svc: Optional["RAGService"] = None
+ready_event = threading.Event()
+load_error: Optional[str] = None
+# Set by app.prefork right after fork so /ready can report per-worker cold start.
+worker_started_at: float = time.time()
+worker_ready_seconds: Optional[float] = None
+# Write end of the prefork master's control pipe; set in forked workers, None otherwise.
+master_pipe: Optional[int] = None
+
+def notify_master(*parts: str):
+    """One line to the prefork master: `ready <pid>` or `reload <version>` (empty version: CURRENT)."""
+    os.write(master_pipe, (" ".join(parts) + "\n").encode("utf-8"))
 
 class AskRequest(BaseModel):
     question: str = Field(..., description="User question")
     components: Optional[List[str]] = Field(default=None, description="Filter by component e.g. ['spark']")
     tags: Optional[List[str]] = Field(default=None, description="Filter by tags e.g. ['apache-spark']")
+    where: Optional[Dict[str, Any]] = Field(default=None, description="Filter expression, e.g. {'and': [{'tag': 'apache-spark'}, {'not': {'tag': 'pyspark'}}]}")
+    min_score: Optional[int] = Field(default=None, description="Only records with score >= min_score")
     top_k: Optional[int] = Field(default=None, description="Top k after fusion")
     fetch_k: Optional[int] = Field(default=None, description="Candidate k for dense retrieval before filtering")
+    deadline_s: Optional[float] = Field(default=None, description="Time budget in seconds (default REQUEST_DEADLINE_SECONDS)")
     debug: bool = Field(default=True, description="Return debug details")
 
 class AskResult(BaseModel):
@@ -25,24 +55,272 @@ class AskResult(BaseModel):
     sources: List[Dict[str, Any]]
     debug: Dict[str, Any]
 
+class SearchRequest(BaseModel):
+    query: str = Field(..., description="Search query")
+    components: Optional[List[str]] = Field(default=None, description="Filter by component e.g. ['spark']")
+    tags: Optional[List[str]] = Field(default=None, description="Filter by tags e.g. ['apache-spark']")
+    where: Optional[Dict[str, Any]] = Field(default=None, description="Filter expression, e.g. {'and': [{'tag': 'apache-spark'}, {'not': {'tag': 'pyspark'}}]}")
+    min_score: Optional[int] = Field(default=None, description="Only records with score >= min_score")
+    top_k: Optional[int] = Field(default=None, description="Top k after fusion")
+    fetch_k: Optional[int] = Field(default=None, description="Candidate k for dense retrieval before filtering")
+    rerank: bool = Field(default=False, description="Rerank fused candidates with RERANK_MODEL if configured")
+    deadline_s: Optional[float] = Field(default=None, description="Time budget in seconds (default REQUEST_DEADLINE_SECONDS)")
+    debug: bool = Field(default=False, description="Return debug details")
+
+class SearchResult(BaseModel):
+    sources: List[Dict[str, Any]]
+    debug: Dict[str, Any]
+
+class AskBatchRequest(BaseModel):
+    questions: List[str] = Field(..., description="Questions answered with shared filters")
+    components: Optional[List[str]] = Field(default=None, description="Filter by component e.g. ['spark']")
+    tags: Optional[List[str]] = Field(default=None, description="Filter by tags e.g. ['apache-spark']")
+    where: Optional[Dict[str, Any]] = Field(default=None, description="Filter expression, e.g. {'and': [{'tag': 'apache-spark'}, {'not': {'tag': 'pyspark'}}]}")
+    min_score: Optional[int] = Field(default=None, description="Only records with score >= min_score")
+    top_k: Optional[int] = Field(default=None, description="Top k after fusion")
+    fetch_k: Optional[int] = Field(default=None, description="Candidate k for dense retrieval before filtering")
+    debug: bool = Field(default=False, description="Return debug details")
+
+class AskBatchItem(BaseModel):
+    result: Optional[AskResult] = None
+    error: Optional[str] = None
+
+class AskBatchResult(BaseModel):
+    results: List[AskBatchItem]
+
+@app.exception_handler(FilterError)
+def _filter_error(request, exc: FilterError):
+    return JSONResponse({"detail": str(exc)}, status_code=400)
+
+@app.exception_handler(Overloaded)
+def _overloaded(request, exc: Overloaded):
+    return JSONResponse({"detail": str(exc), "stage": exc.stage}, status_code=exc.status,
+                        headers={"Retry-After": str(exc.retry_after)})
+
+_GATED = {"/ask", "/search", "/ask/batch"}
+
+@app.middleware("http")
+async def _admission(request: Request, call_next):
+    # Deadlines count from arrival, so time spent queued for a worker thread is part of the budget.
+    request.state.received_at = time.monotonic()
+    if request.url.path not in _GATED:
+        return await call_next(request)
+    # Admit on the event loop, before the sync handler takes a threadpool thread; the body's
+    # deadline_s is not parsed yet, so waiting here is bounded by REQUEST_DEADLINE_SECONDS.
+    budget = settings.request_deadline_seconds
+    deadline = Deadline(request.state.received_at + budget) if budget > 0 else None
+    try:
+        async with request_gate().acquire(deadline):
+            if deadline is not None and deadline.remaining() <= 0:
+                metrics.inc("request_expired")
+                raise Overloaded("request", 503, "deadline expired while queued")
+            return await call_next(request)
+    except Overloaded as e:
+        # Raised outside the routing layer, so the exception handler above does not see it.
+        return _overloaded(request, e)
+
+def _deadline(request: Request, seconds: Optional[float]) -> Optional[Deadline]:
+    budget = seconds if seconds is not None else settings.request_deadline_seconds
+    if not budget or budget <= 0:
+        return None
+    deadline = Deadline(request.state.received_at + budget)
+    if deadline.remaining() <= 0:
+        metrics.inc("request_expired")
+        raise Overloaded("request", 503, "deadline expired while queued")
+    return deadline
+
+# Backoff cap between load attempts: a dependency that is down at startup (embedding
+# endpoint, Milvus, remote shards) must not leave the worker unready for good.
+_LOAD_RETRY_MAX_SECONDS = 60.0
+
+def _load():
+    global svc, load_error, worker_ready_seconds
+    attempt = 0
+    while True:
+        try:
+            # In prefork mode the master has already loaded the indexes before forking.
+            if svc is None:
+                from rag.service import RAGService
+                svc = RAGService(settings.storage_dir)
+            svc.warmup()
+            break
+        except Exception as e:
+            load_error = f"{type(e).__name__}: {e}"
+            delay = min(_LOAD_RETRY_MAX_SECONDS, 2.0 ** attempt)
+            attempt += 1
+            print(f"[startup] index load failed (attempt {attempt}, retrying in {delay:.0f}s): {load_error}",
+                  file=sys.stderr, flush=True)
+            time.sleep(delay)
+    load_error = None
+    worker_ready_seconds = time.time() - worker_started_at
+    ready_event.set()
+    if master_pipe is not None:
+        # The master watches CURRENT and re-forks workers on a new version, so pages stay shared.
+        notify_master("ready", str(os.getpid()))
+    else:
+        svc.start_watcher(settings.index_watch_seconds)
+
 @app.on_event("startup")
 def _startup():
-    global svc
-    svc = RAGService(settings.storage_dir)
+    threading.Thread(target=_load, name="index-load", daemon=True).start()
+
+def require_ready():
+    if not ready_event.is_set():
+        raise HTTPException(status_code=503, detail=load_error or "index loading",
+                            headers={"Retry-After": "5"})
 
 @app.get("/health")
 def health():
-    return {"ok": True, "backend": settings.vector_backend, "collection": settings.milvus_collection}
+    vs = getattr(svc.retriever, "vectorstore", None) if svc is not None else None
+    return {"ok": True, "backend": settings.vector_backend, "collection": getattr(vs, "collection", None)}
+
+@app.get("/ready")
+def ready():
+    ready = ready_event.is_set()
+    body = {
+        "ready": ready,
+        "pid": os.getpid(),
+        "index_version": svc.index_version if svc is not None else None,
+        "index_load_seconds": svc.load_seconds if svc is not None else None,
+        "warmup_seconds": svc.handle.warmup_seconds if svc is not None else None,
+        "worker_ready_seconds": worker_ready_seconds,
+        "error": load_error,
+        **memory_usage_mb(),
+    }
+    return JSONResponse(body, status_code=200 if ready else 503)
+
+@app.get("/metrics")
+def get_metrics():
+    """Counters of this worker process (cache hit rates per tier: answer, search, llm)."""
+    return {"pid": os.getpid(), "index_version": svc.index_version if svc is not None else None,
+            **metrics.snapshot()}
+
+def require_admin(x_admin_token: Optional[str] = Header(default=None)):
+    if not settings.admin_token:
+        if settings.admin_open:
+            return
+        raise HTTPException(status_code=403, detail="admin endpoints disabled: set ADMIN_TOKEN (or ADMIN_OPEN=1)")
+    if x_admin_token is None or not hmac.compare_digest(x_admin_token, settings.admin_token):
+        raise HTTPException(status_code=403, detail="admin token required")
+
+def _profile_mode(request: Request) -> Optional[str]:
+    """X-Profile: 1 | cprofile | sample (admin only), else random 1-in-PROFILE_SAMPLE_N sampling."""
+    header = request.headers.get("x-profile")
+    if not header:
+        return sampled_mode()
+    require_admin(request.headers.get("x-admin-token"))
+    mode = "cprofile" if header.lower() in ("1", "true") else header.lower()
+    if mode not in MODES:
+        raise HTTPException(status_code=400, detail=f"X-Profile must be 1, {' or '.join(MODES)}")
+    return mode
+
+def _record_profile(cap: Optional[Capture], debug: Dict[str, Any], n_sources: int, request: Request,
+                    response: Response):
+    if cap is None:
+        return
+    cap.timings_ms = dict(debug.get("timings_ms") or {})
+    cap.info = {"index_version": debug.get("index_version"), "cache_hit": bool(debug.get("cache_hit")),
+                "degraded": debug.get("degraded"), "n_sources": n_sources}
+    # Only the admin who asked for the profile gets its id; sampled requests stay invisible to callers.
+    if request.headers.get("x-profile"):
+        response.headers["X-Profile-Id"] = cap.id
+
+@app.get("/admin/index", dependencies=[Depends(require_admin), Depends(require_ready)])
+def admin_index():
+    return {"version": svc.index_version, "index_dir": svc.handle.index_dir,
+            "in_flight": svc.handle.in_flight, "load_seconds": svc.handle.load_seconds}
+
+@app.post("/admin/reload", dependencies=[Depends(require_admin), Depends(require_ready)])
+def admin_reload(version: Optional[str] = None):
+    """Load `version` (default: CURRENT) in the background and hot-swap it in.
+
+    Under prefork the master loads it and replaces all workers, so they stay on one version.
+    """
+    if master_pipe is not None:
+        if version is not None and (not version or any(c.isspace() for c in version)):
+            raise HTTPException(status_code=400, detail="invalid version")
+        notify_master("reload", version or "")
+        return {"status": "reloading", "from": svc.index_version, "to": version or "CURRENT", "via": "master"}
+    svc.reload_async(version)
+    return {"status": "reloading", "from": svc.index_version, "to": version or "CURRENT"}
+
+@app.get("/admin/profiles", dependencies=[Depends(require_admin)])
+def admin_profiles(limit: int = 50):
+    """Stored profiles of all workers sharing this storage dir, newest first."""
+    return {"profiles": list_profiles(limit)}
+
+@app.get("/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+def admin_profile(profile_id: str):
+    p = profile_file(profile_id, "meta")
+    if p is None:
+        raise HTTPException(status_code=404, detail="profile not found")
+    return FileResponse(p, media_type="application/json")
+
+@app.get("/admin/profiles/{profile_id}/download", dependencies=[Depends(require_admin)])
+def admin_profile_download(profile_id: str):
+    """cProfile dump (.prof, for pstats / snakeviz) or collapsed stacks (.folded, for flamegraphs)."""
+    p = profile_file(profile_id, "data")
+    if p is None:
+        raise HTTPException(status_code=404, detail="profile not found")
+    return FileResponse(p, media_type="application/octet-stream", filename=p.name)
+
+@app.post("/ask", response_model=AskResult, dependencies=[Depends(require_ready)])
+def ask(req: AskRequest, request: Request, response: Response):
+    deadline = _deadline(request, req.deadline_s)
+    # Profiled requests always collect debug so the stage timings can be stored with the profile.
+    with profile(_profile_mode(request), "/ask", req.model_dump()) as cap:
+        resp = svc.ask(
+            question=req.question,
+            components=req.components,
+            tags=req.tags,
+            top_k=req.top_k,
+            fetch_k=req.fetch_k,
+            debug=req.debug or cap is not None,
+            where=req.where,
+            min_score=req.min_score,
+            deadline=deadline,
+        )
+        _record_profile(cap, resp.debug, len(resp.sources), request, response)
+    return AskResult(answer_md=resp.answer_md, sop=resp.sop, sources=resp.sources,
+                     debug=resp.debug if req.debug else {})
+
+@app.post("/search", response_model=SearchResult, dependencies=[Depends(require_ready)])
+def search(req: SearchRequest, request: Request, response: Response):
+    deadline = _deadline(request, req.deadline_s)
+    with profile(_profile_mode(request), "/search", req.model_dump()) as cap:
+        resp = svc.search(
+            query=req.query,
+            components=req.components,
+            tags=req.tags,
+            top_k=req.top_k,
+            fetch_k=req.fetch_k,
+            use_rerank=req.rerank,
+            debug=req.debug or cap is not None,
+            where=req.where,
+            min_score=req.min_score,
+            deadline=deadline,
+        )
+        _record_profile(cap, resp.debug, len(resp.sources), request, response)
+    return SearchResult(sources=resp.sources, debug=resp.debug if req.debug else {})
 
-@app.post("/ask", response_model=AskResult)
-def ask(req: AskRequest):
-    assert svc is not None
-    resp = svc.ask(
-        question=req.question,
+@app.post("/ask/batch", response_model=AskBatchResult, dependencies=[Depends(require_ready)])
+def ask_batch(req: AskBatchRequest):
+    if len(req.questions) > settings.batch_max_questions:
+        raise HTTPException(status_code=413, detail=f"at most {settings.batch_max_questions} questions per batch")
+    items = []
+    for resp, err in svc.ask_batch(
+        req.questions,
         components=req.components,
         tags=req.tags,
         top_k=req.top_k,
         fetch_k=req.fetch_k,
         debug=req.debug,
-    )
-    return AskResult(answer_md=resp.answer_md, sop=resp.sop, sources=resp.sources, debug=resp.debug)
+        where=req.where,
+        min_score=req.min_score,
+    ):
+        if resp is None:
+            items.append(AskBatchItem(error=err))
+        else:
+            items.append(AskBatchItem(result=AskResult(answer_md=resp.answer_md, sop=resp.sop,
+                                                       sources=resp.sources, debug=resp.debug)))
+    return AskBatchResult(results=items)
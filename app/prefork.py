@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import gc
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, Optional, Set, Tuple
+
+import uvicorn
+
+from rag.config import settings
+
+# How long a reload waits for the replacement workers to report ready before stopping the old ones anyway.
+_ROLL_READY_TIMEOUT = 120.0
+
+def _bind(host: str, port: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+def _run_worker(sock: socket.socket, worker_id: int, pipe: int, warm_first: bool):
+    import app.main as main
+
+    main.worker_started_at = time.time()
+    main.master_pipe = pipe
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    if warm_first:
+        # Replacement worker: warm up before accepting, so a roll never hands requests to a cold worker.
+        main.svc.warmup()
+    config = uvicorn.Config(main.app, log_level="info")
+    server = uvicorn.Server(config)
+    print(f"[prefork] worker {worker_id} pid={os.getpid()} serving index {main.svc.index_version}",
+          file=sys.stderr, flush=True)
+    server.run(sockets=[sock])
+
+def _spawn(sock: socket.socket, worker_id: int, pipe: int, warm_first: bool = True) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            _run_worker(sock, worker_id, pipe, warm_first)
+        except BaseException:
+            print(f"[prefork] worker {worker_id} pid={os.getpid()} crashed:", file=sys.stderr, flush=True)
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stderr.flush()
+            os._exit(code)
+    return pid
+
+def run_prefork(host: str, port: int, workers: int):
+    """Load indexes once in this process, then fork `workers` uvicorn servers.
+
+    Workers inherit the BM25 pickle, FAISS index and embedding model as
+    copy-on-write pages. gc.freeze() moves every object loaded so far into the
+    permanent generation so the collector in each worker does not touch (and
+    thereby copy) those pages.
+
+    Index reloads also go through this process (INDEX_WATCH_SECONDS, SIGHUP, or
+    POST /admin/reload in any worker): it loads the new version, forks a fresh set
+    of workers, and stops the old ones once the new ones are ready, so every worker
+    serves the same version and memory stays shared.
+    """
+    import app.main as main
+    from rag.service import RAGService
+    from rag.utils import memory_usage_mb
+
+    if not hasattr(os, "fork"):
+        raise RuntimeError("--workers > 1 requires a platform with os.fork()")
+
+    main.svc = RAGService(settings.storage_dir)
+    print(f"[prefork] indexes loaded in {main.svc.load_seconds:.2f}s, master {memory_usage_mb()}",
+          file=sys.stderr, flush=True)
+
+    sock = _bind(host, port)
+    # Workers write `ready <pid>` / `reload <version>` lines; writes this short are atomic.
+    rfd, wfd = os.pipe()
+    gc.collect()
+    gc.freeze()
+
+    fork_lock = threading.Lock()  # no fork while the master is half way through loading an index
+    roll = threading.Event()
+    ready: Set[int] = set()
+
+    def _reload(version: Optional[str] = None):
+        with fork_lock:
+            gc.unfreeze()
+            try:
+                info = main.svc.reload(version, warm=False)
+            finally:
+                gc.collect()
+                gc.freeze()
+        print(f"[prefork] index {info['previous']} -> {info['current']}, replacing workers",
+              file=sys.stderr, flush=True)
+        roll.set()
+
+    def _reload_logged(version: Optional[str]):
+        try:
+            _reload(version)
+        except Exception:
+            print(f"[prefork] reload of {version or 'CURRENT'} failed, workers keep "
+                  f"{main.svc.index_version}:", file=sys.stderr)
+            traceback.print_exc()
+            sys.stderr.flush()
+
+    def _reload_async(version: Optional[str]):
+        threading.Thread(target=_reload_logged, args=(version,), name="index-reload", daemon=True).start()
+
+    def _control():
+        with os.fdopen(rfd, "r", encoding="utf-8") as f:
+            for line in f:
+                cmd, _, arg = line.strip().partition(" ")
+                if cmd == "ready":
+                    ready.add(int(arg))
+                elif cmd == "reload":
+                    _reload_async(arg or None)
+
+    threading.Thread(target=_control, name="prefork-control", daemon=True).start()
+    main.svc.start_watcher(settings.index_watch_seconds, reload=_reload)
+
+    children: Dict[int, int] = {}
+    for i in range(workers):
+        children[_spawn(sock, i, wfd, warm_first=False)] = i
+
+    stopping = False
+    retiring: Set[int] = set()
+    # (old pids, new pids, give-up time) while a roll waits for the new workers to be ready.
+    pending: Optional[Tuple[Set[int], Set[int], float]] = None
+
+    def _stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGHUP, lambda signum, frame: _reload_async(None))
+
+    while children:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid:
+            worker_id = children.pop(pid, None)
+            ready.discard(pid)
+            if pending is not None and pid in pending[0]:
+                pending[0].discard(pid)  # due to be replaced anyway
+                continue
+            if worker_id is None or stopping or pid in retiring:
+                retiring.discard(pid)
+                continue
+            print(f"[prefork] worker {worker_id} pid={pid} exited ({status}), respawning",
+                  file=sys.stderr, flush=True)
+            time.sleep(1.0)
+            with fork_lock:
+                new_pid = _spawn(sock, worker_id, wfd)
+            children[new_pid] = worker_id
+            if pending is not None and pid in pending[1]:
+                pending[1].discard(pid)
+                pending[1].add(new_pid)
+            continue
+        if stopping:
+            time.sleep(0.2)
+            continue
+        if roll.is_set():
+            roll.clear()
+            old = set(children) - retiring
+            if pending is not None:
+                old |= pending[0]  # a roll still in progress: its new workers are replaced as well
+            with fork_lock:
+                new = {_spawn(sock, i, wfd): i for i in range(workers)}
+            children.update(new)
+            pending = (old, set(new), time.monotonic() + _ROLL_READY_TIMEOUT)
+        if pending is not None and (pending[1] <= ready or time.monotonic() > pending[2]):
+            for old_pid in pending[0]:
+                retiring.add(old_pid)
+                try:
+                    os.kill(old_pid, signal.SIGTERM)  # uvicorn finishes in-flight requests first
+                except ProcessLookupError:
+                    pass
+            pending = None
+        time.sleep(0.2)
+
+    sock.close()
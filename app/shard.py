@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field
+
+from rag.retrievers.filter_index import FilterError
+
+# Versions kept loaded: the one CURRENT points at plus the one routers may still be on.
+_KEEP_VERSIONS = 2
+# Backoff cap for the watcher retrying a version that failed to load.
+_WATCH_RETRY_MAX_SECONDS = 600.0
+
+class ShardRequest(BaseModel):
+    version: Optional[str] = Field(default=None, description="Index version the router serves")
+    queries: List[str] = Field(..., description="Normalized queries")
+    vectors: List[List[float]] = Field(..., description="Query embeddings, one per query")
+    top_k: int
+    fetch_k: int
+    components: Optional[List[str]] = None
+    tags: Optional[List[str]] = None
+    where: Optional[Dict[str, Any]] = None
+    min_score: Optional[int] = None
+
+def create_app(storage_dir: str, shard: str, version: Optional[str] = None, watch_seconds: float = 0.0) -> FastAPI:
+    """Shard server: the shard's BM25, filters and FAISS index, searched with the router's query vectors.
+
+    No embedding model is loaded here; only the router embeds. Unless `version` pins one,
+    the shard follows CURRENT (polled every `watch_seconds`, and on demand when a router asks
+    for a version it has not loaded) and keeps the previous version loaded while routers catch up.
+    """
+    from rag.index import VERSIONS_DIR, current_version, read_meta, resolve_index_dir, shard_dir
+    from rag.retrievers.sharded import encode_hits, load_shard_retriever, shard_search
+
+    pinned = version is not None
+    loaded: "OrderedDict[str, Tuple[Any, Dict[str, Any]]]" = OrderedDict()
+    lock = threading.Lock()       # guards `loaded`
+    load_lock = threading.Lock()  # one load at a time, without blocking searches of loaded versions
+
+    def _load(v: str) -> Tuple[Any, Dict[str, Any]]:
+        with lock:
+            if v in loaded:
+                loaded.move_to_end(v)
+                return loaded[v]
+        with load_lock:
+            with lock:
+                if v in loaded:
+                    return loaded[v]
+            _, index_dir = resolve_index_dir(storage_dir, v)
+            sdir = shard_dir(index_dir, shard)
+            meta = read_meta(sdir)
+            if not meta:
+                raise LookupError(f"No shard {shard!r} in index version {v}")
+            entry = (load_shard_retriever(sdir), meta)
+            with lock:
+                loaded[v] = entry
+                while len(loaded) > _KEEP_VERSIONS:
+                    loaded.popitem(last=False)
+            return entry
+
+    version, _ = resolve_index_dir(storage_dir, version)
+    _load(version)
+    latest = [version]
+
+    def _watch():
+        failed: Optional[str] = None
+        attempts, retry_at = 0, 0.0
+        while True:
+            time.sleep(watch_seconds)
+            v = current_version(storage_dir)
+            if v is None or v == latest[0]:
+                continue
+            if v == failed and time.monotonic() < retry_at:
+                continue
+            try:
+                _load(v)
+                latest[0], failed, attempts = v, None, 0
+            except Exception:
+                attempts = attempts + 1 if v == failed else 1
+                failed = v
+                delay = min(_WATCH_RETRY_MAX_SECONDS, watch_seconds * 2 ** attempts)
+                retry_at = time.monotonic() + delay
+                print(f"[shard {shard}] failed to load version {v} (attempt {attempts}, retrying in {delay:g}s):",
+                      file=sys.stderr)
+                traceback.print_exc()
+                sys.stderr.flush()
+
+    if not pinned and watch_seconds > 0:
+        threading.Thread(target=_watch, name="shard-watcher", daemon=True).start()
+
+    app = FastAPI(title=f"RAG shard {shard}", version="1.0.0")
+
+    @app.exception_handler(FilterError)
+    def _filter_error(request, exc: FilterError):
+        return JSONResponse({"detail": str(exc)}, status_code=400)
+
+    @app.get("/health")
+    def health():
+        with lock:
+            versions = {v: {"n_chunks": m.get("n_chunks"), "doc_offset": m.get("doc_offset"),
+                            "components": m.get("components")} for v, (_, m) in loaded.items()}
+        return {"ok": True, "shard": shard, "version": latest[0], "pinned": pinned, "pid": os.getpid(),
+                "loaded": versions}
+
+    @app.post("/retrieve")
+    def retrieve(req: ShardRequest):
+        v = req.version or latest[0]
+        with lock:
+            entry = loaded.get(v)
+        if entry is None:
+            if pinned or Path(v).name != v or not (Path(storage_dir) / VERSIONS_DIR / v).is_dir():
+                raise HTTPException(status_code=409, detail=f"shard {shard} does not serve version {v}")
+            try:
+                entry = _load(v)
+            except LookupError as e:
+                raise HTTPException(status_code=409, detail=str(e))
+        retriever, meta = entry
+        if len(req.vectors) != len(req.queries):
+            raise HTTPException(status_code=400, detail="one vector per query required")
+        results = shard_search(retriever, shard, int(meta["doc_offset"]), req.queries, req.vectors,
+                               top_k=req.top_k, fetch_k=req.fetch_k, components=req.components, tags=req.tags,
+                               where=req.where, min_score=req.min_score)
+        # Plain JSONResponse: the hit lists are already JSON-safe, skip FastAPI's encoder pass.
+        return JSONResponse({"shard": shard, "version": v,
+                             "results": [{"dense": encode_hits(d), "sparse": encode_hits(s)} for d, s in results]})
+
+    return app
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import AsyncIterator, Iterator, Optional
+
+from rag.config import settings
+from rag.metrics import metrics
+
+@dataclass
+class Deadline:
+    """Absolute time budget of one request (monotonic clock)."""
+    expires_at: float
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+class Overloaded(Exception):
+    """Raised when a stage cannot admit a request; `status` is 429 (queue full) or 503 (wait timed out)."""
+
+    def __init__(self, stage: str, status: int, reason: str):
+        super().__init__(f"{stage} stage overloaded: {reason}")
+        self.stage = stage
+        self.status = status
+        self.retry_after = settings.admission_retry_after_seconds
+
+class StageLimiter:
+    """At most `limit` concurrent holders and `queue` waiters; waiters give up after `wait_s` or the deadline.
+
+    limit <= 0 disables the stage's limit.
+    """
+
+    def __init__(self, name: str, limit: int, queue: int, wait_s: float):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.wait_s = wait_s
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def _publish(self):
+        metrics.set_gauge(f"{self.name}_active", self.active)
+        metrics.set_gauge(f"{self.name}_queue_depth", self.waiting)
+
+    @contextmanager
+    def acquire(self, deadline: Optional[Deadline] = None) -> Iterator[None]:
+        if self.limit <= 0:
+            yield
+            return
+        with self._cond:
+            if self.active >= self.limit:
+                if self.waiting >= self.queue:
+                    metrics.inc(f"{self.name}_rejected")
+                    raise Overloaded(self.name, 429, "queue full")
+                timeout = self.wait_s if deadline is None else min(self.wait_s, max(0.0, deadline.remaining()))
+                self.waiting += 1
+                self._publish()
+                try:
+                    admitted = self._cond.wait_for(lambda: self.active < self.limit, timeout=timeout)
+                finally:
+                    self.waiting -= 1
+                if not admitted:
+                    metrics.inc(f"{self.name}_wait_timeouts")
+                    self._publish()
+                    raise Overloaded(self.name, 503, f"no slot within {timeout:.1f}s")
+            self.active += 1
+            self._publish()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.active -= 1
+                self._publish()
+                self._cond.notify()
+
+class RequestGate:
+    """Async counterpart of StageLimiter for whole requests, entered on the event loop.
+
+    Sync endpoints run on anyio's threadpool; without this gate, requests beyond
+    the pool size would queue for a thread without bound and only be rejected
+    once they got one.
+    """
+
+    def __init__(self, limit: int, queue: int, wait_s: float):
+        self.limit = limit
+        self.queue = queue
+        self.wait_s = wait_s
+        self.active = 0
+        self.waiting = 0
+        self._sem: Optional[asyncio.Semaphore] = None
+
+    def _publish(self):
+        metrics.set_gauge("request_active", self.active)
+        metrics.set_gauge("request_queue_depth", self.waiting)
+
+    @asynccontextmanager
+    async def acquire(self, deadline: Optional[Deadline] = None) -> AsyncIterator[None]:
+        if self.limit <= 0:
+            yield
+            return
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.limit)
+        if self._sem.locked():
+            if self.waiting >= self.queue:
+                metrics.inc("request_rejected")
+                raise Overloaded("request", 429, "queue full")
+            timeout = self.wait_s if deadline is None else min(self.wait_s, max(0.0, deadline.remaining()))
+            self.waiting += 1
+            self._publish()
+            try:
+                await asyncio.wait_for(self._sem.acquire(), timeout=timeout)
+            except asyncio.TimeoutError:
+                metrics.inc("request_wait_timeouts")
+                raise Overloaded("request", 503, f"no slot within {timeout:.1f}s")
+            finally:
+                self.waiting -= 1
+                self._publish()
+        else:
+            await self._sem.acquire()
+        self.active += 1
+        self._publish()
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._sem.release()
+            self._publish()
+
+@lru_cache(maxsize=None)
+def request_gate() -> RequestGate:
+    return RequestGate(settings.admission_requests, settings.admission_queue, settings.admission_wait_seconds)
+
+_LIMIT_SETTINGS = {"embedding": "admission_embedding", "retrieval": "admission_retrieval", "llm": "admission_llm"}
+
+@lru_cache(maxsize=None)
+def limiter(stage: str) -> StageLimiter:
+    return StageLimiter(stage, getattr(settings, _LIMIT_SETTINGS[stage]),
+                        settings.admission_queue, settings.admission_wait_seconds)
+
+def stage(name: str, deadline: Optional[Deadline] = None):
+    """Context manager holding a slot of stage `name` (embedding | retrieval | llm)."""
+    return limiter(name).acquire(deadline)
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import json
+import os
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from rag.service import RAGService
+
+def _question_of(rec: Dict) -> str:
+    """`question` if present, else the title/body pair used by requests.jsonl."""
+    if rec.get("question"):
+        return str(rec["question"])
+    return "\n\n".join([str(rec[k]) for k in ("title", "body") if rec.get(k)])
+
+def _record_id(rec: Dict, line_no: int) -> str:
+    return str(rec.get("request_id") or rec.get("id") or f"line-{line_no}")
+
+def _completed_ids(out_jsonl: str) -> Set[str]:
+    """Ids already answered in `out_jsonl`; drops a trailing partial line left by a crash."""
+    done: Set[str] = set()
+    if not os.path.exists(out_jsonl):
+        return done
+    with open(out_jsonl, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end != len(data):
+            f.truncate(end)
+    for line in data[:end].decode("utf-8").splitlines():
+        line = line.strip()
+        if line:
+            done.add(str(json.loads(line)["request_id"]))
+    return done
+
+def _pending(in_jsonl: str, done: Set[str]) -> Iterator[Tuple[str, str]]:
+    with open(in_jsonl, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            rec = json.loads(line)
+            rid = _record_id(rec, line_no)
+            if rid not in done:
+                yield rid, _question_of(rec)
+
+def run_batch_file(
+    svc: RAGService,
+    in_jsonl: str,
+    out_jsonl: str,
+    batch_size: int = 64,
+    components: Optional[List[str]] = None,
+    tags: Optional[List[str]] = None,
+    min_score: Optional[int] = None,
+    top_k: Optional[int] = None,
+    concurrency: Optional[int] = None,
+    debug: bool = False,
+    on_error: Optional[Callable[[str, str], None]] = None,
+) -> Dict[str, int]:
+    """Answer every record of `in_jsonl` into `out_jsonl`, resuming after an interruption.
+
+    Results are appended and flushed in input order as they complete; failed
+    records are not written, so a rerun retries them. `on_error(request_id, error)`
+    is called for each failure.
+    """
+    done = _completed_ids(out_jsonl)
+    stats = {"skipped": len(done), "written": 0, "failed": 0}
+
+    def _flush(out, ids: List[str], questions: List[str]):
+        for rid, q, (resp, err) in zip(ids, questions, svc.ask_batch(
+            questions, components=components, tags=tags, min_score=min_score, top_k=top_k, debug=debug,
+            concurrency=concurrency,
+        )):
+            if resp is None:
+                stats["failed"] += 1
+                if on_error is not None:
+                    on_error(rid, err)
+                continue
+            row = {"request_id": rid, "question": q, "answer_md": resp.answer_md,
+                   "sop": resp.sop, "sources": resp.sources}
+            if debug:
+                row["debug"] = resp.debug
+            out.write(json.dumps(row, ensure_ascii=False) + "\n")
+            out.flush()
+            stats["written"] += 1
+
+    with open(out_jsonl, "a", encoding="utf-8") as out:
+        ids: List[str] = []
+        questions: List[str] = []
+        for rid, q in _pending(in_jsonl, done):
+            ids.append(rid)
+            questions.append(q)
+            if len(ids) >= batch_size:
+                _flush(out, ids, questions)
+                ids, questions = [], []
+        if ids:
+            _flush(out, ids, questions)
+    return stats
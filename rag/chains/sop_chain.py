@@ -1,13 +1,22 @@
 from __future__ import annotations
 
+import hashlib
 import json
-from typing import Any, Dict, List
+import os
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
 
 from langchain_core.documents import Document
 from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 
+from rag.config import settings
 from rag.llm import get_llm
+from rag.metrics import metrics
+from rag.utils import normalize_query, sha1_json
+
+# Bump whenever the prompt or schema changes so cached LLM outputs are not reused.
+PROMPT_VERSION = "sop-v1"
 
 SOP_SCHEMA = {
   "type": "object",
@@ -36,8 +45,43 @@ def _format_context(docs: List[Document], max_chars: int = 12000) -> str:
         parts.append(chunk)
     return "".join(parts)
 
-def build_sop_answer(question: str, retrieved_docs: List[Document]) -> Dict[str, Any]:
-    llm = get_llm()
+@lru_cache(maxsize=None)
+def _llm_cache(pid: int):
+    from diskcache import Cache
+    return Cache(os.path.join(settings.cache_dir, "llm"), size_limit=settings.llm_cache_size_mb * 1024 * 1024)
+
+def _chunk_id(d: Document) -> str:
+    """Stable across index versions: record, chunk position and a hash of the chunk text."""
+    md = d.metadata or {}
+    digest = hashlib.sha1(d.page_content.encode("utf-8")).hexdigest()[:12]
+    return f"{md.get('qid')}:{md.get('chunk_id')}:{digest}"
+
+def llm_cache_key(question: str, retrieved_docs: List[Document]) -> str:
+    return sha1_json({"q": normalize_query(question), "model": settings.openai_model,
+                      "temperature": settings.llm_temperature, "prompt": PROMPT_VERSION,
+                      "chunks": [_chunk_id(d) for d in retrieved_docs]})
+
+def build_sop_answer(question: str, retrieved_docs: List[Document],
+                     timeout: Optional[float] = None) -> Dict[str, Any]:
+    """LLM SOP answer, memoized on the exact retrieved context (LLM_CACHE_TTL_SECONDS).
+
+    `timeout` (the request's remaining budget) caps the LLM call below LLM_TIMEOUT_SECONDS.
+    """
+    if settings.llm_cache_ttl_seconds <= 0:
+        return _generate_sop(question, retrieved_docs, timeout)
+    cache = _llm_cache(os.getpid())
+    key = llm_cache_key(question, retrieved_docs)
+    sop: Optional[Dict[str, Any]] = cache.get(key, default=None)
+    if sop is not None:
+        metrics.inc("llm_cache_hits")
+        return sop
+    metrics.inc("llm_cache_misses")
+    sop = _generate_sop(question, retrieved_docs, timeout)
+    cache.set(key, sop, expire=settings.llm_cache_ttl_seconds)
+    return sop
+
+def _generate_sop(question: str, retrieved_docs: List[Document], timeout: Optional[float] = None) -> Dict[str, Any]:
+    llm = get_llm(timeout)
     parser = JsonOutputParser()
 
     prompt = ChatPromptTemplate.from_messages([
@@ -49,7 +93,8 @@ def build_sop_answer(question: str, retrieved_docs: List[Document]) -> Dict[str,
          "用户问题：\n{question}\n\n"
          "检索上下文：\n{context}\n\n"
          "请生成一个标准化排障结果 JSON，字段遵循以下 JSON Schema（仅用作结构参考，不要输出 schema）：\n"
-         f"{json.dumps(SOP_SCHEMA, ensure_ascii=False)}\n\n"
+         # braces escaped: the prompt is a format template
+         + json.dumps(SOP_SCHEMA, ensure_ascii=False).replace("{", "{{").replace("}", "}}") + "\n\n"
          "要求：\n"
          "1) checks/步骤尽量可操作（命令/配置项/日志路径）\n"
          "2) references 里给出你引用的 Source 编号（如 'Source 2'）与其标题\n")
@@ -62,3 +107,26 @@ def build_sop_answer(question: str, retrieved_docs: List[Document]) -> Dict[str,
         return json.loads(out.content)
     except Exception:
         return parser.parse(out.content)
+
+def _answer_excerpt(text: str, max_chars: int = 300) -> str:
+    body = text.split("Answer:\n", 1)[1] if "Answer:\n" in text else text
+    body = " ".join(body.split())
+    return body[:max_chars] + ("…" if len(body) > max_chars else "")
+
+def extractive_sop(question: str, retrieved_docs: List[Document], reason: str, max_sources: int = 3) -> Dict[str, Any]:
+    """SOP-shaped fallback built only from the retrieved answers, used when the LLM stage fails."""
+    steps, refs = [], []
+    for i, d in enumerate(retrieved_docs[:max_sources], start=1):
+        title = (d.metadata or {}).get("title", "")
+        steps.append(f"参考 Source {i}（{title}）：{_answer_excerpt(d.page_content)}")
+        refs.append(f"Source {i}: {title}")
+    return {
+        "summary": f"LLM 生成不可用（{reason}），以下为检索到的相关回答摘录，请人工判断。",
+        "possible_causes": [],
+        "checks": [],
+        "step_by_step_sop": steps,
+        "mitigations": [],
+        "rollback_plan": [],
+        "when_to_escalate": [],
+        "references": refs,
+    }
@@ -16,26 +16,80 @@ class Settings:
     openai_base_url: str = _get("OPENAI_BASE_URL", "")
     openai_model: str = _get("OPENAI_MODEL", "gpt-4o-mini")
     llm_temperature: float = float(_get("LLM_TEMPERATURE", "0.2"))
+    llm_concurrency: int = int(_get("LLM_CONCURRENCY", "4"))  # parallel LLM calls per batch
+    llm_timeout_seconds: float = float(_get("LLM_TIMEOUT_SECONDS", "30"))  # past this /ask degrades to extractive
+    llm_max_retries: int = int(_get("LLM_MAX_RETRIES", "1"))
 
     # Embeddings
+    embedding_provider: str = _get("EMBEDDING_PROVIDER", "huggingface").lower()  # huggingface|openai (OPENAI_BASE_URL)
     embedding_model: str = _get("EMBEDDING_MODEL", "BAAI/bge-base-en-v1.5")
     embedding_device: str = _get("EMBEDDING_DEVICE", "cpu")
+    embedding_batch: int = int(_get("EMBEDDING_BATCH", "256"))  # texts per embed call during index builds
+    embedding_store: bool = _get("EMBEDDING_STORE", "1") == "1"  # reuse vectors of unchanged chunks across builds
 
     # Storage
     storage_dir: str = _get("STORAGE_DIR", "storage")
     vector_backend: str = _get("VECTOR_BACKEND", "faiss").lower()  # faiss|milvus
+    index_keep_versions: int = int(_get("INDEX_KEEP_VERSIONS", "3"))
+    index_watch_seconds: float = float(_get("INDEX_WATCH_SECONDS", "0"))  # 0 disables the watcher
+    index_drain_seconds: float = float(_get("INDEX_DRAIN_SECONDS", "30"))
+    warmup_batch: int = int(_get("WARMUP_BATCH", "8"))  # dummy texts embedded before /ready; 0 skips warm-up
+
+    # Admin endpoints and X-Profile (X-Admin-Token header); without a token they are disabled
+    admin_token: str = _get("ADMIN_TOKEN", "")
+    admin_open: bool = _get("ADMIN_OPEN", "0") == "1"  # no token required (local development only)
+
+    # Profiling (X-Profile header for admins, or 1 in N requests); saved under <storage>/profiles
+    profile_sample_n: int = int(_get("PROFILE_SAMPLE_N", "0"))  # 0 disables random sampling
+    profile_sample_mode: str = _get("PROFILE_SAMPLE_MODE", "sample").lower()  # sample|cprofile
+    profile_interval_ms: float = float(_get("PROFILE_INTERVAL_MS", "5"))  # stack sampler tick
+    profile_keep: int = int(_get("PROFILE_KEEP", "200"))  # newest profiles kept per storage dir
 
     # Milvus
     milvus_uri: str = _get("MILVUS_URI", "http://localhost:19530")
-    milvus_collection: str = _get("MILVUS_COLLECTION", "stack_rag")
+    milvus_collection: str = _get("MILVUS_COLLECTION", "stack_rag")  # prefix of per-version collections
+    milvus_insert_batch: int = int(_get("MILVUS_INSERT_BATCH", "512"))
+    milvus_insert_workers: int = int(_get("MILVUS_INSERT_WORKERS", "4"))
+    milvus_insert_retries: int = int(_get("MILVUS_INSERT_RETRIES", "3"))
 
     # Retrieval
     top_k: int = int(_get("TOP_K", "8"))
     fetch_k: int = int(_get("FETCH_K", "40"))
     rrf_c: int = int(_get("RRF_C", "60"))
+    rrf_dense_weight: float = float(_get("RRF_DENSE_WEIGHT", "1.0"))
+    rrf_bm25_weight: float = float(_get("RRF_BM25_WEIGHT", "1.0"))
+    batch_max_questions: int = int(_get("BATCH_MAX_QUESTIONS", "256"))
+    bm25_cjk_ngram: int = int(_get("BM25_CJK_NGRAM", "2"))  # CJK n-gram size; 0 keeps whole runs (fixed per index)
+    bm25_query_cache_size: int = int(_get("BM25_QUERY_CACHE_SIZE", "4096"))  # LRU entries of tokenized queries
+
+    # Admission control: concurrent slots per stage (0 = unlimited), bounded wait queue, request deadline
+    # /ask, /search, /ask/batch let past the event loop per worker; keep below the threadpool size (40)
+    admission_requests: int = int(_get("ADMISSION_REQUESTS", "32"))
+    admission_embedding: int = int(_get("ADMISSION_EMBEDDING", "4"))
+    admission_retrieval: int = int(_get("ADMISSION_RETRIEVAL", "8"))
+    admission_llm: int = int(_get("ADMISSION_LLM", "16"))
+    admission_queue: int = int(_get("ADMISSION_QUEUE", "32"))  # waiters per stage before 429
+    admission_wait_seconds: float = float(_get("ADMISSION_WAIT_SECONDS", "5"))  # queue wait before 503
+    admission_retry_after_seconds: int = int(_get("ADMISSION_RETRY_AFTER_SECONDS", "2"))
+    request_deadline_seconds: float = float(_get("REQUEST_DEADLINE_SECONDS", "30"))  # 0 disables
+    llm_min_seconds: float = float(_get("LLM_MIN_SECONDS", "2"))  # less budget left: sources-only answer
+    rerank_min_seconds: float = float(_get("RERANK_MIN_SECONDS", "0.5"))
+
+    # Sharded indexes (build-index --shard-by): shards listed here are remote, the rest load in-process
+    shard_urls: str = _get("SHARD_URLS", "")  # e.g. spark=http://10.0.0.5:8101,kafka=http://10.0.0.6:8101
+    shard_timeout_seconds: float = float(_get("SHARD_TIMEOUT_SECONDS", "2"))  # slower shards are left out
+    shard_workers: int = int(_get("SHARD_WORKERS", "32"))  # scatter threads per worker process
+
+    # Rerank (optional cross-encoder, e.g. BAAI/bge-reranker-base); empty disables
+    rerank_model: str = _get("RERANK_MODEL", "")
+    rerank_candidates: int = int(_get("RERANK_CANDIDATES", "20"))
 
     # Cache
     cache_dir: str = _get("CACHE_DIR", "storage/cache")
     cache_ttl_seconds: int = int(_get("CACHE_TTL_SECONDS", "3600"))
+    search_cache_ttl_seconds: int = int(_get("SEARCH_CACHE_TTL_SECONDS", "600"))
+    # LLM outputs keyed on (question, model, prompt version, retrieved chunks); outlives answer-cache expiry
+    llm_cache_ttl_seconds: int = int(_get("LLM_CACHE_TTL_SECONDS", "86400"))  # 0 disables
+    llm_cache_size_mb: int = int(_get("LLM_CACHE_SIZE_MB", "512"))
 
 settings = Settings()
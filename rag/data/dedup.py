@@ -0,0 +1,298 @@
+from __future__ import annotations
+
+import json
+import os
+import random
+import time
+import zlib
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from rag.retrievers.tokenizer import CJK_RE, TOKEN_RE, tokenize
+
+_SHIFT32 = np.uint64(32)
+_MASK32 = np.uint64(0xFFFFFFFF)
+_BLOCK_SHINGLES = 1 << 15  # shingles hashed per block: block x num_perm uint64 (32 MB at 128 perms)
+_VERIFY_PAIRS = 1 << 16
+_ALL_PAIRS_BUCKET = 32  # buckets up to this size are verified pairwise; larger ones as star + chain
+
+@dataclass
+class DedupConfig:
+    num_perm: int = 128         # MinHash permutations
+    bands: int = 32             # LSH bands; num_perm / bands rows each
+    shingle: int = 3            # word n-gram size
+    threshold: float = 0.8      # estimated Jaccard a candidate pair needs to be merged
+    same_component: bool = True  # only merge records of the same component
+    seed: int = 1
+
+def record_text(rec: Dict) -> str:
+    return f"{rec.get('title') or ''}\n{rec.get('question') or ''}\n{rec.get('answer') or ''}"
+
+def term_hashes(text: str) -> np.ndarray:
+    """crc32 of each lowercased word (CJK runs as character bigrams); no vocabulary to build or share."""
+    text = text.lower()
+    words = tokenize(text, 2) if CJK_RE.search(text) else TOKEN_RE.findall(text)
+    return np.fromiter(map(zlib.crc32, map(str.encode, words)), dtype=np.uint64, count=len(words))
+
+def _mix64(x: np.ndarray) -> np.ndarray:
+    # splitmix64 finalizer: spreads the combined token ids over all 64 bits (wrapping arithmetic).
+    with np.errstate(over="ignore"):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+def shingle_hashes(terms: np.ndarray, k: int) -> np.ndarray:
+    """Distinct 32-bit hashes of the word k-grams of one document (the words themselves if it is shorter)."""
+    t = terms.astype(np.uint64)
+    k = max(1, min(k, len(t)))
+    if len(t) == 0:
+        return np.empty(0, dtype=np.uint64)
+    h = np.zeros(len(t) - k + 1, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for j in range(k):
+            h = h * np.uint64(0x100000001B3) + t[j:len(t) - k + 1 + j] + np.uint64(1)
+    return np.unique(_mix64(h) & _MASK32)
+
+def minhash_signatures(shingles: Sequence[np.ndarray], num_perm: int, seed: int = 1) -> np.ndarray:
+    """(n_docs, num_perm) uint32 MinHash signatures; documents without shingles get all-ones rows.
+
+    Hash i is the multiply-shift hash (a_i * x + b_i) >> 32 over 64-bit words (a_i odd),
+    which avoids a modulo per cell; whole blocks of documents are hashed as one matrix
+    and reduced per document with np.minimum.reduceat.
+    """
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, 1 << 62, size=num_perm, dtype=np.int64).astype(np.uint64) << np.uint64(1) | np.uint64(1)
+    b = rng.randint(0, 1 << 62, size=num_perm, dtype=np.int64).astype(np.uint64) << np.uint64(2)
+    sig = np.full((len(shingles), num_perm), 0xFFFFFFFF, dtype=np.uint32)
+    lens = np.fromiter((len(s) for s in shingles), dtype=np.int64, count=len(shingles))
+
+    start = 0
+    while start < len(shingles):
+        end, total = start, 0
+        while end < len(shingles) and (total == 0 or total + lens[end] <= _BLOCK_SHINGLES):
+            total += lens[end]
+            end += 1
+        docs = np.flatnonzero(lens[start:end]) + start
+        if len(docs):
+            x = np.concatenate([shingles[i] for i in docs])
+            # (num_perm, shingles) so each per-document minimum runs over contiguous memory.
+            h = np.multiply.outer(a, x)
+            h += b[:, None]
+            h >>= _SHIFT32
+            offsets = np.concatenate([[0], np.cumsum(lens[docs])[:-1]])
+            sig[docs] = np.minimum.reduceat(h, offsets, axis=1).T.astype(np.uint32)
+        start = end
+    return sig
+
+def _band_keys(sig: np.ndarray, bands: int, groups: np.ndarray, seed: int) -> List[np.ndarray]:
+    rows = sig.shape[1] // bands
+    rng = np.random.RandomState(seed + 1)
+    mult = rng.randint(1, 1 << 62, size=rows + 1, dtype=np.int64).astype(np.uint64) | np.uint64(1)
+    keys = []
+    with np.errstate(over="ignore"):
+        for j in range(bands):
+            band = sig[:, j * rows:(j + 1) * rows].astype(np.uint64)
+            keys.append(_mix64(band @ mult[:rows] + groups * mult[rows]))
+    return keys
+
+def candidate_pairs(sig: np.ndarray, bands: int, groups: np.ndarray, seed: int = 1) -> np.ndarray:
+    """(m, 2) unique index pairs sharing at least one LSH band bucket.
+
+    Buckets of up to _ALL_PAIRS_BUCKET members yield all their pairs. Larger ones (mostly
+    exact duplicates) pair each member with the first and with its neighbour.
+    """
+    valid = np.flatnonzero(sig[:, 0] != 0xFFFFFFFF)
+    parts = []
+    for keys in _band_keys(sig[valid], bands, groups[valid].astype(np.uint64), seed):
+        order = np.argsort(keys, kind="stable")
+        sk = keys[order]
+        n = len(sk)
+        is_first = np.ones(n, dtype=bool)
+        is_first[1:] = sk[1:] != sk[:-1]
+        starts = np.flatnonzero(is_first)
+        sizes = np.diff(np.append(starts, n))
+        if sizes.max(initial=1) < 2:
+            continue
+        bucket = np.cumsum(is_first) - 1
+        end = (starts + sizes)[bucket]
+        small = (sizes <= _ALL_PAIRS_BUCKET)[bucket]
+        pos = np.arange(n)
+        star = ~small & ~is_first
+        parts.append(np.stack([valid[order[starts[bucket[star]]]], valid[order[star]]], axis=1))
+        for d in range(1, min(_ALL_PAIRS_BUCKET, int(sizes.max()))):
+            m = pos[:n - d][(pos[:n - d] + d < end[:n - d]) & (small[:n - d] | (d == 1))]
+            if not len(m):
+                break
+            parts.append(np.stack([valid[order[m]], valid[order[m + d]]], axis=1))
+    if not parts:
+        return np.empty((0, 2), dtype=np.int64)
+    pairs = np.concatenate(parts)
+    return np.unique(np.sort(pairs, axis=1), axis=0)
+
+def estimated_jaccard(sig: np.ndarray, pairs: np.ndarray) -> np.ndarray:
+    out = np.empty(len(pairs), dtype=np.float64)
+    for s in range(0, len(pairs), _VERIFY_PAIRS):
+        p = pairs[s:s + _VERIFY_PAIRS]
+        out[s:s + len(p)] = (sig[p[:, 0]] == sig[p[:, 1]]).mean(axis=1)
+    return out
+
+def _union_find(n: int, pairs: np.ndarray) -> np.ndarray:
+    parent = list(range(n))
+
+    def find(i: int) -> int:
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    for i, j in pairs.tolist():
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+    return np.fromiter((find(i) for i in range(n)), dtype=np.int64, count=n)
+
+def find_clusters(records: Sequence[Dict], cfg: DedupConfig) -> Tuple[np.ndarray, Dict[str, Any]]:
+    """Cluster label per record (index of the cluster's first record) and pipeline counts."""
+    if cfg.num_perm % cfg.bands:
+        raise ValueError(f"num_perm ({cfg.num_perm}) must be a multiple of bands ({cfg.bands})")
+    shingles = [shingle_hashes(term_hashes(record_text(r)), cfg.shingle) for r in records]
+    sig = minhash_signatures(shingles, cfg.num_perm, cfg.seed)
+    if cfg.same_component:
+        comps: Dict[str, int] = {}
+        groups = np.fromiter((comps.setdefault(str(r.get("component") or "").lower(), len(comps)) for r in records),
+                             dtype=np.int64, count=len(records))
+    else:
+        groups = np.zeros(len(records), dtype=np.int64)
+    pairs = candidate_pairs(sig, cfg.bands, groups, cfg.seed)
+    kept = pairs[estimated_jaccard(sig, pairs) >= cfg.threshold]
+    return _union_find(len(records), kept), {"candidate_pairs": int(len(pairs)), "merged_pairs": int(len(kept))}
+
+def _rank(rec: Dict) -> Tuple:
+    # Accepted answer first, then score; the oldest question wins ties.
+    return (bool(rec.get("accepted")), int(rec.get("score") or 0), -int(rec.get("qid") or 0))
+
+def dedup_records(records: List[Dict], cfg: Optional[DedupConfig] = None) -> Tuple[List[Dict], Dict[str, Any]]:
+    """Keep the best record of each near-duplicate cluster, in input order.
+
+    The kept record lists the dropped qids in `merged_qids` and takes the union
+    of the cluster's tags, so tag filters still reach it.
+    """
+    cfg = cfg or DedupConfig()
+    t0 = time.perf_counter()
+    labels, counts = find_clusters(records, cfg)
+    members: Dict[int, List[int]] = {}
+    for i, label in enumerate(labels.tolist()):
+        members.setdefault(label, []).append(i)
+
+    best = {label: max(idx, key=lambda i: _rank(records[i])) for label, idx in members.items()}
+    out: List[Dict] = []
+    examples = []
+    for i, rec in enumerate(records):
+        label = int(labels[i])
+        if best[label] != i:
+            continue
+        idx = members[label]
+        if len(idx) > 1:
+            rec = dict(rec)
+            rec["merged_qids"] = [records[j].get("qid") for j in idx if j != i]
+            tags = list(rec.get("tags") or [])
+            for j in idx:
+                tags.extend(t for t in (records[j].get("tags") or []) if t not in tags)
+            rec["tags"] = tags
+            if len(examples) < 5:
+                examples.append({"kept": rec.get("qid"), "title": rec.get("title"), "merged": rec["merged_qids"]})
+        out.append(rec)
+
+    sizes = [len(v) for v in members.values()]
+    report = {
+        "n_in": len(records),
+        "n_out": len(out),
+        "removed": len(records) - len(out),
+        "reduction": round(1 - len(out) / len(records), 4) if records else 0.0,
+        "clusters": sum(1 for s in sizes if s > 1),
+        "largest_cluster": max(sizes, default=0),
+        **counts,
+        "seconds": round(time.perf_counter() - t0, 2),
+        "config": asdict(cfg),
+        "examples": examples,
+    }
+    return out, report
+
+def dedup_jsonl(in_path: str, out_path: str, cfg: Optional[DedupConfig] = None) -> Dict[str, Any]:
+    from rag.data.documents import load_records
+
+    records, report = dedup_records(load_records(in_path), cfg)
+    with open(out_path, "w", encoding="utf-8") as f:
+        for rec in records:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    return report
+
+def _dir_mb(path: str) -> float:
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return round(total / 1e6, 2)
+
+def evaluate(data_jsonl: str, storage_dir: str, cfg: Optional[DedupConfig] = None, n_queries: int = 500,
+             top_k: int = 8, fetch_k: int = 40, chunk_size: int = 900, chunk_overlap: int = 150,
+             seed: int = 0) -> Dict[str, Any]:
+    """Build the corpus with and without dedup (sharing one embedding store) and compare retrieval.
+
+    Queries are record titles. A hit is any result from the query record's
+    near-duplicate cluster, so finding the twin counts on both indexes;
+    `distinct_records` is the mean number of different clusters in the top-k.
+    """
+    from rag.data.documents import load_records
+    from rag.index import build_all
+    from rag.service import load_index
+
+    cfg = cfg or DedupConfig()
+    records = load_records(data_jsonl)
+    labels, _ = find_clusters(records, cfg)
+    label_of = {r.get("qid"): int(l) for r, l in zip(records, labels.tolist())}
+    cluster_size = np.bincount(labels, minlength=len(records))
+
+    rng = random.Random(seed)
+    sample = rng.sample(range(len(records)), min(n_queries, len(records)))
+    queries = [str(records[i].get("title") or records[i].get("question", "")[:200]) for i in sample]
+    targets = [int(labels[i]) for i in sample]
+    in_dup = np.array([cluster_size[t] > 1 for t in targets])
+
+    report: Dict[str, Any] = {"n_queries": len(queries), "dup_queries": int(in_dup.sum()), "top_k": top_k}
+    for name, dedup in (("full", None), ("dedup", cfg)):
+        meta = build_all(data_jsonl, "faiss", storage_dir, chunk_size, chunk_overlap, dedup=dedup)
+        # Always a FAISS build, whatever VECTOR_BACKEND says.
+        retriever = load_index(storage_dir, meta["version"], backend="faiss").retriever
+        t0 = time.perf_counter()
+        results = []
+        for s in range(0, len(queries), 64):
+            results.extend(retriever.retrieve_batch(queries[s:s + 64], top_k=top_k, fetch_k=fetch_k))
+        ms = (time.perf_counter() - t0) * 1000 / max(len(queries), 1)
+
+        hit, rr, distinct = [], [], []
+        for (fused, _), target in zip(results, targets):
+            found = [label_of.get(d.metadata.get("qid"), -1) for d, _ in fused]
+            rank = found.index(target) + 1 if target in found else 0
+            hit.append(rank > 0)
+            rr.append(1 / rank if rank else 0.0)
+            distinct.append(len(set(found)))
+        hit, rr, distinct = np.array(hit), np.array(rr), np.array(distinct, dtype=np.float64)
+        dup = in_dup if in_dup.any() else np.ones(len(hit), dtype=bool)
+        report[name] = {
+            "version": meta["version"],
+            "n_docs": meta["n_docs"],
+            "n_chunks": meta["n_chunks"],
+            "index_mb": _dir_mb(os.path.join(storage_dir, "versions", meta["version"])),
+            f"hit@{top_k}": round(float(hit.mean()), 4),
+            f"mrr@{top_k}": round(float(rr.mean()), 4),
+            f"hit@{top_k}_dup_queries": round(float(hit[dup].mean()), 4),
+            "distinct_records": round(float(distinct.mean()), 2),
+            "ms_per_query": round(ms, 2),
+        }
+    report["reduction"] = {"docs": round(1 - report["dedup"]["n_docs"] / max(report["full"]["n_docs"], 1), 4),
+                           "chunks": round(1 - report["dedup"]["n_chunks"] / max(report["full"]["n_chunks"], 1), 4)}
+    return report
@@ -38,6 +38,9 @@ def record_to_document(rec: Dict) -> Document:
         "accepted": rec.get("accepted", False),
         "title": rec.get("title", ""),
     }
+    if rec.get("merged_qids"):
+        # Near-duplicate questions folded into this record by rag.data.dedup.
+        metadata["merged_qids"] = rec["merged_qids"]
     return Document(page_content=content, metadata=metadata)
 
 def build_documents(jsonl_path: str) -> List[Document]:
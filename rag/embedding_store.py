@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from rag.config import settings
+from rag.utils import normalize_query
+
+try:
+    import fcntl
+except ImportError:  # Windows: builds are not serialized across processes
+    fcntl = None
+
+# <storage>/embeddings/<model hash>/
+#   keys.sqlite   key (sha1 of model + normalized text) -> row
+#   vectors.f16   float16 rows of `dim` values, append-only, read through np.memmap
+#   append.lock   flock held while appending, so concurrent builds never interleave rows
+KEYS_FILE = "keys.sqlite"
+VECTORS_FILE = "vectors.f16"
+LOCK_FILE = "append.lock"
+
+def embedding_key(model: str, text: str) -> str:
+    return hashlib.sha1(f"{model}\0{normalize_query(text)}".encode("utf-8")).hexdigest()
+
+class EmbeddingStore:
+    """Content-addressed cache of document embeddings shared by every index build.
+
+    Vectors are appended to the row file and fsynced before their keys are
+    committed, so a crash can leave unreferenced rows but never a key pointing
+    at a missing vector; a torn partial row is cut off before the next append.
+    Vectors are returned as float32 from their float16 copy whether they were
+    hits or misses, so a rebuild is bit-for-bit stable.
+    """
+
+    def __init__(self, root: str, model: str):
+        self.model = model
+        self.dir = Path(root) / hashlib.sha1(model.encode("utf-8")).hexdigest()[:16]
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.dir / KEYS_FILE), check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS emb (key TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self._db.execute("INSERT OR IGNORE INTO meta VALUES ('model', ?)", (model,))
+        self._db.commit()
+        dim = self._db.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        self.dim: Optional[int] = int(dim[0]) if dim else None
+        self._mm: Optional[np.memmap] = None
+        self.hits = 0
+        self.misses = 0
+        self.embed_seconds = 0.0
+
+    @property
+    def rows(self) -> int:
+        path = self.dir / VECTORS_FILE
+        if self.dim is None or not path.exists():
+            return 0
+        return path.stat().st_size // (2 * self.dim)
+
+    def _matrix(self, need_rows: int) -> np.memmap:
+        if self._mm is None or self._mm.shape[0] < need_rows:
+            self._mm = np.memmap(self.dir / VECTORS_FILE, dtype=np.float16, mode="r", shape=(self.rows, self.dim))
+        return self._mm
+
+    def _lookup(self, keys: Sequence[str]) -> Dict[str, int]:
+        found: Dict[str, int] = {}
+        uniq = list(dict.fromkeys(keys))
+        for s in range(0, len(uniq), 500):
+            part = uniq[s:s + 500]
+            q = f"SELECT key, row FROM emb WHERE key IN ({','.join('?' * len(part))})"
+            found.update(self._db.execute(q, part).fetchall())
+        return found
+
+    @contextmanager
+    def _append_lock(self) -> Iterator[None]:
+        with open(self.dir / LOCK_FILE, "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _append(self, keys: List[str], vectors: np.ndarray) -> List[int]:
+        vectors = np.asarray(vectors, dtype=np.float16)
+        with self._append_lock():
+            if self.dim is None:
+                # Another build may have stored the first vectors since this store was opened.
+                dim = self._db.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+                self.dim = int(dim[0]) if dim else int(vectors.shape[1])
+                self._db.execute("INSERT OR REPLACE INTO meta VALUES ('dim', ?)", (str(self.dim),))
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"embedding dim changed for {self.model}: {vectors.shape[1]} != {self.dim}")
+            start = self.rows
+            with open(self.dir / VECTORS_FILE, "ab") as f:
+                # Row numbers are offsets: drop a torn row a crashed write left behind before appending.
+                f.truncate(start * 2 * self.dim)
+                f.write(np.ascontiguousarray(vectors).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            rows = list(range(start, start + len(keys)))
+            self._db.executemany("INSERT OR REPLACE INTO emb VALUES (?, ?)", zip(keys, rows))
+            self._db.commit()
+        return rows
+
+    def embed(self, texts: Sequence[str], embeddings, batch_size: Optional[int] = None) -> np.ndarray:
+        """(len(texts), dim) float32; only texts never seen with this model are sent to `embeddings`."""
+        batch_size = batch_size or settings.embedding_batch
+        keys = [embedding_key(self.model, t) for t in texts]
+        with self._lock:
+            found = self._lookup(keys)
+        misses: Dict[str, str] = {}
+        for k, t in zip(keys, texts):
+            if k not in found:
+                misses.setdefault(k, t)
+
+        miss_keys = list(misses)
+        for s in range(0, len(miss_keys), batch_size):
+            part = miss_keys[s:s + batch_size]
+            t0 = time.perf_counter()
+            vectors = embeddings.embed_documents([misses[k] for k in part])
+            elapsed = time.perf_counter() - t0
+            with self._lock:
+                found.update(zip(part, self._append(part, vectors)))
+                self.embed_seconds += elapsed
+
+        with self._lock:
+            self.misses += len(miss_keys)
+            self.hits += len(keys) - len(miss_keys)
+            if not keys:
+                return np.empty((0, self.dim or 0), dtype=np.float32)
+            rows = np.fromiter((found[k] for k in keys), dtype=np.int64, count=len(keys))
+            return np.asarray(self._matrix(int(rows.max()) + 1)[rows], dtype=np.float32)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "embed_seconds": round(self.embed_seconds, 2), "rows": self.rows}
+
+    def close(self):
+        self._mm = None
+        self._db.close()
+
+def open_store(storage_dir: str) -> Optional[EmbeddingStore]:
+    """Store for the configured embedding model, or None when EMBEDDING_STORE is off."""
+    if not settings.embedding_store:
+        return None
+    return EmbeddingStore(os.path.join(storage_dir, "embeddings"), settings.embedding_model)
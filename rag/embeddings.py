@@ -6,6 +6,13 @@ def get_embeddings():
     model_name = settings.embedding_model
     device = settings.embedding_device
 
+    if settings.embedding_provider == "openai":
+        from langchain_openai import OpenAIEmbeddings
+        kwargs = {"base_url": settings.openai_base_url} if settings.openai_base_url else {}
+        # Send raw strings: gateways and mock servers do not all accept tiktoken ids.
+        return OpenAIEmbeddings(model=model_name, api_key=settings.openai_api_key,
+                                check_embedding_ctx_length=False, **kwargs)
+
     try:
         from langchain_huggingface import HuggingFaceEmbeddings
         return HuggingFaceEmbeddings(
@@ -1,40 +1,182 @@
 from __future__ import annotations
 
+import hashlib
 import json
+import os
+import shutil
+import sys
+import time
+from datetime import datetime
 from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
 
 from rag.config import settings
-from rag.data.documents import CorpusConfig, build_documents, chunk_documents
-from rag.retrievers.persistent_bm25 import PersistentBM25
+from rag.data.documents import CorpusConfig, chunk_documents, load_records, record_to_document
+from rag.embedding_store import EmbeddingStore, open_store
+from rag.retrievers.filter_index import FilterIndex
+from rag.retrievers.persistent_bm25 import CorpusStats, PersistentBM25
 
-def _paths(storage_dir: str):
-    base = Path(storage_dir)
+if TYPE_CHECKING:
+    from rag.data.dedup import DedupConfig
+
+# storage/
+#   CURRENT            -> name of the live version (replaced atomically)
+#   versions/<version>/{faiss/, bm25.pkl, filters.npz, meta.json}
+#   versions/<version>/{shards/<name>/{faiss/, bm25.pkl, filters.npz, meta.json}, meta.json}   (sharded build)
+CURRENT_FILE = "CURRENT"
+VERSIONS_DIR = "versions"
+SHARDS_DIR = "shards"
+LEGACY_VERSION = "legacy"
+SHARD_BY = ("component", "hash")
+# A version dir without meta.json this old is a failed build, not one still being written.
+_FAILED_BUILD_SECONDS = 24 * 3600
+
+def _paths(index_dir: str):
+    base = Path(index_dir)
     return {
         "faiss": base / "faiss",
         "bm25": base / "bm25.pkl",
+        "filters": base / "filters.npz",
         "meta": base / "meta.json",
     }
 
-def build_all(data_jsonl: str, backend: str, storage_dir: str, chunk_size: int, chunk_overlap: int):
-    p = _paths(storage_dir)
-    Path(storage_dir).mkdir(parents=True, exist_ok=True)
+def current_version(storage_dir: str) -> Optional[str]:
+    p = Path(storage_dir) / CURRENT_FILE
+    try:
+        v = p.read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        return None
+    return v or None
 
-    docs = build_documents(data_jsonl)
-    chunks = chunk_documents(docs, CorpusConfig(chunk_size=chunk_size, chunk_overlap=chunk_overlap))
+def resolve_index_dir(storage_dir: str, version: Optional[str] = None) -> Tuple[str, str]:
+    """Return (version, index_dir). Falls back to the flat pre-versioning layout."""
+    version = version or current_version(storage_dir)
+    if version is None:
+        return LEGACY_VERSION, storage_dir
+    return version, str(Path(storage_dir) / VERSIONS_DIR / version)
+
+def publish_version(storage_dir: str, version: str):
+    """Atomically point CURRENT at `version` (write temp file, fsync, rename)."""
+    base = Path(storage_dir)
+    if not (base / VERSIONS_DIR / version).is_dir():
+        raise ValueError(f"Unknown index version: {version}")
+    tmp = base / f".{CURRENT_FILE}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(version + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, base / CURRENT_FILE)
+
+def _drop_milvus_collection(version_dir: Path, keep: set) -> bool:
+    """Drop the Milvus collection a version was built into; False if it could not be dropped."""
+    collection = (read_meta(str(version_dir)).get("milvus") or {}).get("collection")
+    if not collection or collection in keep:
+        return True
+    from rag.vectorstores.milvus_store import drop_collection
+    try:
+        drop_collection(collection)
+    except Exception as e:
+        print(f"[prune] keeping version {version_dir.name}: cannot drop Milvus collection {collection}: {e}",
+              file=sys.stderr)
+        return False
+    return True
+
+def prune_versions(storage_dir: str, keep: int):
+    """Delete all but the newest `keep` built versions (never CURRENT), with their Milvus collections.
+
+    Directories without meta.json are failed (or still running) builds: they never count towards
+    `keep`, and are deleted once untouched for _FAILED_BUILD_SECONDS.
+    """
+    vdir = Path(storage_dir) / VERSIONS_DIR
+    if keep <= 0 or not vdir.is_dir():
+        return
+    live = current_version(storage_dir)
+    dirs = sorted([p for p in vdir.iterdir() if p.is_dir()], key=lambda p: p.name)
+    versions = [p for p in dirs if _paths(str(p))["meta"].exists() or p.name == live]
+    for p in dirs:
+        if p not in versions and time.time() - p.stat().st_mtime > _FAILED_BUILD_SECONDS:
+            shutil.rmtree(p, ignore_errors=True)
+    stale = [p for p in versions[:-keep] if p.name != live]
+    kept = {(read_meta(str(p)).get("milvus") or {}).get("collection") for p in versions if p not in stale}
+    for p in stale:
+        # A version whose collection survives stays on disk, so the next prune retries the drop.
+        if _drop_milvus_collection(p, kept):
+            shutil.rmtree(p, ignore_errors=True)
+
+def read_meta(index_dir: str) -> Dict[str, Any]:
+    """meta.json of an index (or shard) directory; {} for indexes that predate it."""
+    p = _paths(index_dir)["meta"]
+    return json.loads(p.read_text(encoding="utf-8")) if p.exists() else {}
 
-    bm25 = PersistentBM25.build(chunks)
+def shard_dir(index_dir: str, name: str) -> str:
+    return str(Path(index_dir) / SHARDS_DIR / name)
+
+def _shard_of(doc: Document, shard_by: str, n_shards: int) -> str:
+    if shard_by == "component":
+        return str(doc.metadata.get("component") or "other").lower()
+    # Hash the question id, not the chunk, so every chunk of a record lands in the same shard.
+    h = int(hashlib.sha1(str(doc.metadata.get("qid", "")).encode("utf-8")).hexdigest()[:8], 16)
+    return f"hash-{h % n_shards:02d}"
+
+def split_shards(chunks: List[Document], shard_by: str, n_shards: int = 0) -> Dict[str, List[Document]]:
+    if shard_by not in SHARD_BY:
+        raise ValueError(f"Unknown shard_by: {shard_by} (expected one of {', '.join(SHARD_BY)})")
+    if shard_by == "hash" and n_shards < 1:
+        raise ValueError("hash sharding needs n_shards >= 1")
+    groups: Dict[str, List[Document]] = {}
+    for c in chunks:
+        groups.setdefault(_shard_of(c, shard_by, n_shards), []).append(c)
+    return dict(sorted(groups.items()))
+
+def _build_parts(chunks: List[Document], index_dir: Path, backend: str, storage_dir: str,
+                 store: Optional[EmbeddingStore], stats: Optional[CorpusStats] = None,
+                 encoded: Optional[list] = None) -> Dict[str, Any]:
+    """BM25, filters and vectors of one index directory; chunk doc_ids must be 0..n-1."""
+    p = _paths(str(index_dir))
+    index_dir.mkdir(parents=True, exist_ok=True)
+    bm25 = PersistentBM25.build(chunks, stats=stats, encoded=encoded)
     bm25.save(str(p["bm25"]))
+    FilterIndex.build(chunks).save(str(p["filters"]))
 
     if backend == "faiss":
         from rag.vectorstores.faiss_store import build_faiss
-        build_faiss(chunks, str(p["faiss"]))
+        backend_info = build_faiss(chunks, str(p["faiss"]), store=store)
     elif backend == "milvus":
         from rag.vectorstores.milvus_store import build_milvus
-        build_milvus(chunks)
+        # Ingestion checkpoints live at the storage root so a rerun can resume them.
+        backend_info = build_milvus(chunks, state_dir=storage_dir, store=store)
     else:
         raise ValueError(f"Unknown backend: {backend}")
 
-    meta = {
+    meta: Dict[str, Any] = {"n_chunks": len(chunks),
+                            "bm25": {"vocab": len(bm25.tokenizer.vocab), "cjk_ngram": bm25.tokenizer.cjk_ngram}}
+    if backend_info:
+        meta[backend] = backend_info
+    return meta
+
+def build_all(data_jsonl: str, backend: str, storage_dir: str, chunk_size: int, chunk_overlap: int,
+              shard_by: Optional[str] = None, n_shards: int = 0, dedup: Optional["DedupConfig"] = None):
+    """Build and publish a new index version; `shard_by` (component | hash) writes one sub-index per shard,
+    `dedup` merges near-duplicate records (MinHash LSH) before chunking."""
+    if shard_by and backend != "faiss":
+        raise ValueError("sharded indexes need the faiss backend (Milvus shards collections itself)")
+    version = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    index_dir = Path(storage_dir) / VERSIONS_DIR / version
+    p = _paths(str(index_dir))
+    index_dir.mkdir(parents=True, exist_ok=True)
+
+    records = load_records(data_jsonl)
+    dedup_report = None
+    if dedup is not None:
+        from rag.data.dedup import dedup_records
+        records, dedup_report = dedup_records(records, dedup)
+    docs = [record_to_document(r) for r in records]
+    chunks = chunk_documents(docs, CorpusConfig(chunk_size=chunk_size, chunk_overlap=chunk_overlap))
+
+    meta: Dict[str, Any] = {
+        "version": version,
         "backend": backend,
         "chunk_size": chunk_size,
         "chunk_overlap": chunk_overlap,
@@ -42,20 +184,69 @@ def build_all(data_jsonl: str, backend: str, storage_dir: str, chunk_size: int,
         "n_chunks": len(chunks),
         "embedding_model": settings.embedding_model,
     }
+    if dedup_report is not None:
+        meta["dedup"] = dedup_report
+    # Shared across versions: only chunks whose text changed since any earlier build get embedded.
+    store = open_store(storage_dir)
+    try:
+        if not shard_by:
+            # Stable integer identity per chunk: BM25 row, FAISS docstore id and Milvus key all equal doc_id.
+            for i, c in enumerate(chunks):
+                c.metadata["doc_id"] = i
+            meta.update(_build_parts(chunks, index_dir, backend, storage_dir, store))
+        else:
+            # Each shard numbers its chunks from 0 (row == FAISS position == mask bit); the
+            # global doc_id is doc_offset + local id, so shard ranges never overlap.
+            # BM25 vocabulary and idf are corpus-wide so shard scores match the unsharded index.
+            stats, encoded = CorpusStats.fit(chunks)
+            row_of = {id(c): i for i, c in enumerate(chunks)}
+            shards, offset = [], 0
+            for name, part in split_shards(chunks, shard_by, n_shards).items():
+                part_encoded = [encoded[row_of[id(c)]] for c in part]
+                for i, c in enumerate(part):
+                    c.metadata["doc_id"] = i
+                info = _build_parts(part, Path(shard_dir(str(index_dir), name)), backend, storage_dir, store,
+                                    stats, part_encoded)
+                info.update({"shard": name, "doc_offset": offset, "version": version,
+                             "components": sorted({str(c.metadata.get("component") or "").lower() for c in part})})
+                _paths(shard_dir(str(index_dir), name))["meta"].write_text(
+                    json.dumps(info, ensure_ascii=False, indent=2), encoding="utf-8")
+                shards.append({k: info[k] for k in ("shard", "doc_offset", "n_chunks", "components")})
+                offset += len(part)
+            meta.update({"shard_by": shard_by, "shards": shards})
+    finally:
+        if store is not None:
+            store.close()
+
+    if store is not None:
+        meta["embedding_store"] = store.stats()
     p["meta"].write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    # Only a fully written version directory ever becomes visible to readers.
+    publish_version(storage_dir, version)
+    prune_versions(storage_dir, settings.index_keep_versions)
     return meta
 
-def load_vectorstore(storage_dir: str):
-    backend = settings.vector_backend
-    p = _paths(storage_dir)
+def load_vectorstore(index_dir: str, embeddings=None, backend: Optional[str] = None):
+    """`embeddings` overrides the configured model (shard servers get query vectors from the router);
+    `backend` overrides VECTOR_BACKEND."""
+    backend = backend or settings.vector_backend
+    p = _paths(index_dir)
     if backend == "faiss":
         from rag.vectorstores.faiss_store import load_faiss
-        return load_faiss(str(p["faiss"]))
+        return load_faiss(str(p["faiss"]), embeddings)
     if backend == "milvus":
         from rag.vectorstores.milvus_store import load_milvus
-        return load_milvus()
+        # Each version searches the collection it was built into, so reload / rollback swaps it too.
+        return load_milvus((read_meta(index_dir).get("milvus") or {}).get("collection"))
     raise ValueError(f"Unknown backend: {backend}")
 
-def load_bm25(storage_dir: str) -> PersistentBM25:
-    p = _paths(storage_dir)
+def load_bm25(index_dir: str) -> PersistentBM25:
+    p = _paths(index_dir)
     return PersistentBM25.load(str(p["bm25"]))
+
+def load_filters(index_dir: str, bm25: PersistentBM25) -> FilterIndex:
+    p = _paths(index_dir)
+    filters = FilterIndex.load(str(p["filters"])) if p["filters"].exists() else None
+    # Index built before filters.npz (or one of its fields) existed.
+    return filters if filters is not None else FilterIndex.build(bm25.index.docs)
@@ -1,9 +1,19 @@
 from __future__ import annotations
+from typing import Optional
+
 from rag.config import settings
 
-def get_llm():
+def get_llm(timeout: Optional[float] = None):
+    """`timeout` (seconds) lowers LLM_TIMEOUT_SECONDS for this client, e.g. to a request's remaining budget.
+
+    With a budget there are no retries: a retry could spend the remaining budget a second time.
+    """
     from langchain_openai import ChatOpenAI
-    kwargs = {"model": settings.openai_model, "temperature": settings.llm_temperature}
+    kwargs = {"model": settings.openai_model, "temperature": settings.llm_temperature,
+              "max_retries": settings.llm_max_retries if timeout is None else 0}
+    limits = [t for t in (settings.llm_timeout_seconds, timeout) if t is not None and t > 0]
+    if limits:
+        kwargs["timeout"] = min(limits)
     if settings.openai_base_url:
         kwargs["base_url"] = settings.openai_base_url
     return ChatOpenAI(api_key=settings.openai_api_key, **kwargs)
@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+
+_COMPONENTS = ["spark", "flink", "kafka", "hadoop", "hive"]
+_SYMPTOMS = [
+    "executor OOM during shuffle", "job stuck at the last stage", "consumer lag keeps growing",
+    "checkpoint timeout", "NameNode in safe mode", "metastore connection refused",
+    "container killed by YARN for exceeding memory limits", "slow query after upgrade",
+    "rebalance storm after deploy", "small files slow down the scan",
+]
+_TEMPLATES = ["{c} {s}, how to troubleshoot?", "why does {c} report {s}", "{s} in {c} production cluster"]
+
+@dataclass
+class LoadConfig:
+    endpoint: str = "/ask"
+    rps: float = 0.0           # > 0: open loop with Poisson arrivals; otherwise closed loop
+    concurrency: int = 8       # closed-loop clients
+    duration_s: float = 30.0
+    max_requests: int = 0      # 0 = until duration_s
+    repeat_ratio: float = 0.2  # fraction of requests that replay an earlier query (exercises caches)
+    timeout_s: float = 120.0
+    seed: int = 0
+
+def load_queries(path: str) -> List[str]:
+    """JSONL records (question, or title/body as in requests.jsonl) or one query per plain-text line."""
+    from rag.batch import _question_of
+    out: List[str] = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            out.append(_question_of(json.loads(line)) if line.startswith("{") else line)
+    return out
+
+def synthesize_queries(n: int, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    return [rng.choice(_TEMPLATES).format(c=rng.choice(_COMPONENTS), s=rng.choice(_SYMPTOMS)) for _ in range(n)]
+
+def query_stream(pool: List[str], repeat_ratio: float, seed: int = 0) -> Iterator[str]:
+    rng = random.Random(seed)
+    sent: List[str] = []
+    i = 0
+    while True:
+        if sent and rng.random() < repeat_ratio:
+            q = rng.choice(sent)
+        else:
+            q = pool[i % len(pool)]
+            i += 1
+            sent.append(q)
+        yield q
+
+def _payload(endpoint: str, q: str) -> Dict[str, Any]:
+    return {"query": q, "debug": True} if endpoint.startswith("/search") else {"question": q, "debug": True}
+
+async def _generate(base_url: str, queries: Iterator[str], cfg: LoadConfig) -> List[Dict[str, Any]]:
+    import httpx
+
+    results: List[Dict[str, Any]] = []
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=max(cfg.concurrency, 32))
+    async with httpx.AsyncClient(base_url=base_url, timeout=cfg.timeout_s, limits=limits) as client:
+
+        async def _one(q: str, scheduled: float):
+            status, body = 0, None
+            try:
+                r = await client.post(cfg.endpoint, json=_payload(cfg.endpoint, q))
+                status = r.status_code
+                if status == 200:
+                    body = r.json()
+            except Exception as e:
+                status = type(e).__name__
+            # Measured from the scheduled send time so queueing in the client is not hidden (open loop).
+            results.append({"status": status, "latency_ms": (time.perf_counter() - scheduled) * 1000,
+                            "debug": (body or {}).get("debug") or {}})
+
+        start = time.perf_counter()
+        deadline = start + cfg.duration_s
+        budget = cfg.max_requests or float("inf")
+
+        if cfg.rps > 0:
+            rng = random.Random(cfg.seed)
+            tasks, t, n = [], start, 0
+            while n < budget:
+                t += rng.expovariate(cfg.rps)
+                if t >= deadline:
+                    break
+                await asyncio.sleep(max(0.0, t - time.perf_counter()))
+                tasks.append(asyncio.create_task(_one(next(queries), t)))
+                n += 1
+            await asyncio.gather(*tasks)
+        else:
+            counter = {"n": 0}
+
+            async def _client():
+                while time.perf_counter() < deadline and counter["n"] < budget:
+                    counter["n"] += 1
+                    await _one(next(queries), time.perf_counter())
+
+            await asyncio.gather(*[_client() for _ in range(max(1, cfg.concurrency))])
+    return results
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    a = np.asarray(values)
+    out = {f"p{p}": round(float(np.percentile(a, p)), 1) for p in (50, 90, 95, 99)}
+    out.update({"mean": round(float(a.mean()), 1), "max": round(float(a.max()), 1)})
+    return out
+
+def _cache_ratios(before: Dict[str, Any], after: Dict[str, Any]) -> Dict[str, Any]:
+    """Per-tier hit ratios over the run only (difference of /metrics counters)."""
+    b, a = before.get("counters", {}), after.get("counters", {})
+    delta = {k: a.get(k, 0) - b.get(k, 0) for k in a}
+    out = {}
+    for name in delta:
+        if name.endswith("_hits"):
+            base = name[:-len("_hits")]
+            hits, misses = delta[name], delta.get(f"{base}_misses", 0)
+            out[base] = {"hits": hits, "misses": misses,
+                         "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0}
+    return out
+
+def summarize(results: List[Dict[str, Any]], elapsed_s: float,
+              metrics_before: Dict[str, Any], metrics_after: Dict[str, Any]) -> Dict[str, Any]:
+    ok = [r for r in results if r["status"] == 200]
+    errors: Dict[str, int] = {}
+    for r in results:
+        if r["status"] != 200:
+            errors[str(r["status"])] = errors.get(str(r["status"]), 0) + 1
+    stages: Dict[str, List[float]] = {}
+    for r in ok:
+        if r["debug"].get("cache_hit"):
+            continue  # timings of the original computation
+        for name, ms in (r["debug"].get("timings_ms") or {}).items():
+            stages.setdefault(name, []).append(ms)
+    return {
+        "requests": len(results),
+        "ok": len(ok),
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else 0.0,
+        "errors": errors,
+        "cache_hit_responses": sum(1 for r in ok if r["debug"].get("cache_hit")),
+        "degraded": sum(1 for r in ok if r["debug"].get("degraded")),
+        "elapsed_s": round(elapsed_s, 2),
+        "throughput_rps": round(len(ok) / elapsed_s, 2) if elapsed_s else 0.0,
+        "latency_ms": _percentiles([r["latency_ms"] for r in ok]),
+        "stage_ms": {name: _percentiles(v) for name, v in sorted(stages.items())},
+        "caches": _cache_ratios(metrics_before, metrics_after),
+    }
+
+def _get_json(base_url: str, path: str) -> Dict[str, Any]:
+    import httpx
+    try:
+        r = httpx.get(base_url + path, timeout=10)
+        return r.json() if r.status_code == 200 else {}
+    except Exception:
+        return {}
+
+def run_loadtest(base_url: str, queries: Iterator[str], cfg: LoadConfig) -> Dict[str, Any]:
+    """Drive `base_url` with `queries` and report throughput, latency, errors and cache ratios.
+
+    /metrics is per worker process; run the target with one worker for exact cache ratios.
+    """
+    before = _get_json(base_url, "/metrics")
+    t0 = time.perf_counter()
+    results = asyncio.run(_generate(base_url, queries, cfg))
+    elapsed = time.perf_counter() - t0
+    after = _get_json(base_url, "/metrics")
+    report = summarize(results, elapsed, before, after)
+    report["config"] = {"endpoint": cfg.endpoint, "rps": cfg.rps, "concurrency": cfg.concurrency,
+                        "duration_s": cfg.duration_s, "max_requests": cfg.max_requests,
+                        "repeat_ratio": cfg.repeat_ratio, "seed": cfg.seed}
+    return report
+
+def spawn_server(port: int, workers: int, env: Dict[str, str]) -> subprocess.Popen:
+    cmd = [sys.executable, "-m", "scripts.cli", "serve", "--host", "127.0.0.1", "--port", str(port),
+           "--workers", str(workers)]
+    return subprocess.Popen(cmd, env={**os.environ, **env})
+
+def wait_ready(base_url: str, timeout_s: float, proc: Optional[subprocess.Popen] = None):
+    deadline = time.time() + timeout_s
+    while time.time() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f"server exited with code {proc.returncode}")
+        if _get_json(base_url, "/ready").get("ready"):
+            return
+        time.sleep(0.5)
+    raise TimeoutError(f"{base_url} not ready after {timeout_s:.0f}s")
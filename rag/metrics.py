@@ -0,0 +1,38 @@
+from __future__ import annotations
+
+import threading
+from collections import defaultdict
+from typing import Dict
+
+class Metrics:
+    """Process-local counters and gauges (per worker in prefork mode), exposed by GET /metrics.
+
+    Counter pairs named `<x>_hits` / `<x>_misses` also get a derived `<x>_hit_rate`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = defaultdict(int)
+        self._gauges: Dict[str, float] = {}
+
+    def inc(self, name: str, n: float = 1):
+        with self._lock:
+            self._counters[name] += n
+
+    def set_gauge(self, name: str, value: float):
+        with self._lock:
+            self._gauges[name] = value
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+        ratios = {}
+        for name, hits in counters.items():
+            if name.endswith("_hits"):
+                base = name[:-len("_hits")]
+                total = hits + counters.get(f"{base}_misses", 0)
+                ratios[f"{base}_hit_rate"] = round(hits / total, 4) if total else 0.0
+        return {"counters": counters, "gauges": gauges, "ratios": ratios}
+
+metrics = Metrics()
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+# Valid against SOP_SCHEMA so the SOP chain parses it like a real answer.
+_SOP = {
+    "summary": "Mock answer generated by the load-test server.",
+    "possible_causes": ["executor memory too small", "data skew"],
+    "checks": ["yarn logs -applicationId <app_id>", "check spark.executor.memory"],
+    "step_by_step_sop": ["inspect the failed stage", "raise executor memory", "rerun the job"],
+    "mitigations": ["enable adaptive query execution"],
+    "rollback_plan": ["restore the previous job configuration"],
+    "when_to_escalate": ["failures persist after two reruns"],
+    "references": ["Source 1"],
+}
+
+@dataclass
+class MockConfig:
+    llm_latency_ms: float = 300.0      # time to first token
+    llm_tokens_per_s: float = 200.0    # generation speed after the first token
+    llm_output_tokens: int = 150
+    embed_latency_ms: float = 5.0      # per request
+    embed_item_ms: float = 0.2         # per input text
+    embed_dim: int = 384
+    error_rate: float = 0.0            # fraction of chat calls answered with HTTP 500
+    jitter: float = 0.1                # +/- fraction applied to every latency
+    seed: int = 0
+
+def _hash_vector(item: Any, dim: int) -> np.ndarray:
+    """Deterministic unit vector from the input's words, so similar texts land near each other."""
+    text = item if isinstance(item, str) else json.dumps(item)
+    v = np.zeros(dim, dtype=np.float32)
+    for w in text.lower().split():
+        v[int(hashlib.md5(w.encode("utf-8")).hexdigest()[:8], 16) % dim] += 1.0
+    n = float(np.linalg.norm(v)) or 1.0
+    return v / n
+
+def _encode_vector(v: np.ndarray, encoding_format: str) -> Any:
+    # The openai SDK asks for base64 float32 unless the caller picks a format.
+    if encoding_format == "base64":
+        return base64.b64encode(v.astype(np.float32).tobytes()).decode("ascii")
+    return v.tolist()
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "MockOpenAIServer"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: Dict[str, Any]):
+        raw = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send(200, {"object": "list", "data": [{"id": "mock", "object": "model"}]})
+        else:
+            self._send(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path.endswith("/chat/completions"):
+            self._send(*self.server.chat(body))
+        elif self.path.endswith("/embeddings"):
+            self._send(*self.server.embeddings(body))
+        else:
+            self._send(404, {"error": {"message": f"unknown path {self.path}"}})
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    """OpenAI-compatible /v1/chat/completions and /v1/embeddings with configurable latency."""
+
+    daemon_threads = True
+
+    def __init__(self, host: str, port: int, config: MockConfig):
+        super().__init__((host, port), _Handler)
+        self.config = config
+        self._rng = random.Random(config.seed)
+        self._lock = threading.Lock()
+        self.counts = {"chat": 0, "embeddings": 0, "errors": 0}
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def _sleep(self, ms: float):
+        with self._lock:
+            j = self._rng.uniform(-self.config.jitter, self.config.jitter)
+        time.sleep(max(0.0, ms * (1 + j)) / 1000)
+
+    def chat(self, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        c = self.config
+        with self._lock:
+            self.counts["chat"] += 1
+            fail = self._rng.random() < c.error_rate
+        if fail:
+            with self._lock:
+                self.counts["errors"] += 1
+            self._sleep(c.llm_latency_ms)
+            return 500, {"error": {"message": "mock upstream error", "type": "server_error"}}
+        self._sleep(c.llm_latency_ms + 1000 * c.llm_output_tokens / max(c.llm_tokens_per_s, 1e-6))
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in body.get("messages", [])) // 4
+        return 200, {
+            "id": f"chatcmpl-mock-{time.time_ns()}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": json.dumps(_SOP, ensure_ascii=False)}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": c.llm_output_tokens,
+                      "total_tokens": prompt_tokens + c.llm_output_tokens},
+        }
+
+    def embeddings(self, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        c = self.config
+        inputs = body.get("input", [])
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        with self._lock:
+            self.counts["embeddings"] += 1
+        self._sleep(c.embed_latency_ms + c.embed_item_ms * len(inputs))
+        return 200, {
+            "object": "list",
+            "model": body.get("model", "mock"),
+            "data": [{"object": "embedding", "index": i,
+                      "embedding": _encode_vector(_hash_vector(x, c.embed_dim), body.get("encoding_format", "float"))}
+                     for i, x in enumerate(inputs)],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        }
+
+def start_mock_server(host: str = "127.0.0.1", port: int = 0, config: Optional[MockConfig] = None) -> MockOpenAIServer:
+    """Serve in a daemon thread; port 0 picks a free port (see `.base_url`)."""
+    server = MockOpenAIServer(host, port, config or MockConfig())
+    threading.Thread(target=server.serve_forever, name="mock-openai", daemon=True).start()
+    return server
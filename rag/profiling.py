@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import cProfile
+import json
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from rag.config import settings
+
+# <storage>/profiles/<id>.json   request, stage timings, top functions
+#                    <id>.prof   cProfile dump (python -m pstats / snakeviz), or
+#                    <id>.folded collapsed stacks of the sampler (flamegraph.pl / speedscope)
+MODES = ("cprofile", "sample")
+PROFILE_ID_RE = re.compile(r"^[0-9]{8}-[0-9]{6}-[0-9a-f]{8}$")
+_TOP = 30
+
+# Before 3.12 cProfile hooks are per thread, from 3.12 only one profiler may be active per process.
+_cprofile_lock = threading.Lock()
+
+def profile_dir() -> Path:
+    return Path(settings.storage_dir) / "profiles"
+
+def sampled_mode() -> Optional[str]:
+    """PROFILE_SAMPLE_MODE for about 1 in PROFILE_SAMPLE_N requests, else None."""
+    n = settings.profile_sample_n
+    return settings.profile_sample_mode if n > 0 and random.random() * n < 1 else None
+
+def _func(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+class StackSampler:
+    """Samples one thread's Python stack every `interval` seconds from a helper thread.
+
+    The profiled thread runs unmodified; the cost is one sys._current_frames()
+    call per tick, so it is cheap enough for randomly sampled production requests.
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_func(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+    def top(self, n: int = _TOP) -> List[Dict[str, Any]]:
+        """Functions by self samples (leaf frame), with their inclusive share."""
+        total = sum(self.stacks.values()) or 1
+        own: Counter = Counter()
+        inclusive: Counter = Counter()
+        for stack, count in self.stacks.items():
+            funcs = stack.split(";")
+            own[funcs[-1]] += count
+            for f in set(funcs):
+                inclusive[f] += count
+        return [{"func": f, "self_pct": round(100 * c / total, 1), "total_pct": round(100 * inclusive[f] / total, 1)}
+                for f, c in own.most_common(n)]
+
+def _cprofile_top(prof: cProfile.Profile, n: int = _TOP) -> List[Dict[str, Any]]:
+    stats = pstats.Stats(prof).stats
+    rows = sorted(stats.items(), key=lambda kv: kv[1][3], reverse=True)[:n]
+    return [{"func": f"{os.path.basename(file)}:{line}({name})", "ncalls": nc,
+             "tottime_ms": round(tt * 1000, 3), "cumtime_ms": round(ct * 1000, 3)}
+            for (file, line, name), (_, nc, tt, ct, _) in rows]
+
+class Capture:
+    """One profiled request; fill `timings_ms` / `info` inside the `profile()` block."""
+
+    def __init__(self, mode: str, endpoint: str, request: Dict[str, Any]):
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.mode = mode
+        self.endpoint = endpoint
+        self.request = request
+        self.timings_ms: Dict[str, float] = {}
+        self.info: Dict[str, Any] = {}
+
+def _prune(root: Path, keep: int):
+    metas = sorted(root.glob("*.json"))
+    for meta in metas[:-keep] if keep > 0 else []:
+        for p in root.glob(meta.stem + ".*"):
+            p.unlink(missing_ok=True)
+
+@contextmanager
+def profile(mode: Optional[str], endpoint: str, request: Dict[str, Any]) -> Iterator[Optional[Capture]]:
+    """Profile the enclosed block (this thread only) and save it under storage/profiles/; no-op if mode is None.
+
+    cProfile falls back to the sampler while another cProfile capture is running.
+    """
+    if mode is None:
+        yield None
+        return
+    cap = Capture(mode, endpoint, request)
+    prof = sampler = None
+    if mode == "cprofile" and _cprofile_lock.acquire(blocking=False):
+        prof = cProfile.Profile()
+    else:
+        cap.mode = "sample"
+        sampler = StackSampler(threading.get_ident(), settings.profile_interval_ms / 1000)
+
+    t0 = time.perf_counter()
+    try:
+        if prof is not None:
+            prof.enable()
+        else:
+            sampler.start()
+        yield cap
+    except BaseException as e:
+        cap.info["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        if prof is not None:
+            prof.disable()
+            _cprofile_lock.release()
+        else:
+            sampler.stop()
+        total_ms = (time.perf_counter() - t0) * 1000
+        root = profile_dir()
+        root.mkdir(parents=True, exist_ok=True)
+        if prof is not None:
+            prof.dump_stats(str(root / f"{cap.id}.prof"))
+            top = _cprofile_top(prof)
+        else:
+            (root / f"{cap.id}.folded").write_text(sampler.folded(), encoding="utf-8")
+            top = sampler.top()
+        meta = {"id": cap.id, "mode": cap.mode, "endpoint": endpoint, "pid": os.getpid(),
+                "created_at": time.time(), "total_ms": round(total_ms, 3), "request": cap.request,
+                "timings_ms": cap.timings_ms, **cap.info, "top": top}
+        (root / f"{cap.id}.json").write_text(json.dumps(meta, ensure_ascii=False, indent=2, default=str),
+                                              encoding="utf-8")
+        _prune(root, settings.profile_keep)
+
+def list_profiles(limit: int = 50) -> List[Dict[str, Any]]:
+    """Newest first, without the per-function tables."""
+    out = []
+    for p in sorted(profile_dir().glob("*.json"), reverse=True)[:limit]:
+        try:
+            meta = json.loads(p.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            continue  # being written or pruned by another worker
+        meta.pop("top", None)
+        out.append(meta)
+    return out
+
+def profile_file(profile_id: str, kind: str = "meta") -> Optional[Path]:
+    """Path of a stored profile (`kind`: meta | data), or None; ids are validated against path traversal."""
+    if not PROFILE_ID_RE.match(profile_id):
+        return None
+    suffixes = (".json",) if kind == "meta" else (".prof", ".folded")
+    for suffix in suffixes:
+        p = profile_dir() / f"{profile_id}{suffix}"
+        if p.exists():
+            return p
+    return None
@@ -0,0 +1,24 @@
+from __future__ import annotations
+
+from functools import lru_cache
+from typing import List, Tuple
+
+from langchain_core.documents import Document
+
+from rag.config import settings
+
+@lru_cache(maxsize=1)
+def get_reranker():
+    """Cross-encoder named by RERANK_MODEL, or None when reranking is not configured."""
+    if not settings.rerank_model:
+        return None
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(settings.rerank_model, device=settings.embedding_device)
+
+def rerank(query: str, docs: List[Document], top_k: int) -> List[Tuple[Document, float]]:
+    model = get_reranker()
+    if model is None or not docs:
+        return [(d, 0.0) for d in docs[:top_k]]
+    scores = model.predict([(query, d.page_content) for d in docs])
+    ranked = sorted(zip(docs, [float(s) for s in scores]), key=lambda x: x[1], reverse=True)
+    return ranked[:top_k]
@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from langchain_core.documents import Document
+
+# A filter expression is a small JSON tree, e.g.
+#   {"and": [{"component": ["spark", "flink"]}, {"not": {"tag": "pyspark"}}]}
+# Leaves: {"component": name | [names]}, {"tag": name | [names]} (a list means OR),
+#         {"min_score": n} (record score >= n).
+FilterExpr = Dict[str, Any]
+
+class FilterError(ValueError):
+    pass
+
+def filter_node(expr: Any) -> Tuple[str, Any]:
+    """Validate one node of a filter expression; returns (op, arg) with leaf names as a list of str.
+
+    Children of not / and / or are validated when they are evaluated.
+    """
+    if not isinstance(expr, dict) or len(expr) != 1:
+        raise FilterError(f"Filter node must have exactly one key: {expr}")
+    op, arg = next(iter(expr.items()))
+    if op in ("component", "tag"):
+        names = [arg] if isinstance(arg, str) else arg
+        if not isinstance(names, list) or not all(isinstance(x, str) for x in names):
+            raise FilterError(f"'{op}' takes a string or a list of strings: {arg!r}")
+        return op, names
+    if op == "min_score":
+        if isinstance(arg, bool) or not isinstance(arg, int):
+            raise FilterError(f"'min_score' takes an integer: {arg!r}")
+        return op, arg
+    if op == "not":
+        return op, arg
+    if op in ("and", "or"):
+        if not isinstance(arg, list) or not arg:
+            # An empty and/or has no agreed meaning (all rows vs. no rows), so it is rejected everywhere.
+            raise FilterError(f"'{op}' takes a non-empty list of filter nodes: {arg!r}")
+        return op, arg
+    raise FilterError(f"Unknown filter operator: {op}")
+
+# A value covering fewer than 1 row in _SPARSE_RATIO is stored as sorted int32 row ids (4 bytes per row)
+# rather than a packed bitmap (n/8 bytes): tag frequencies are long-tailed, so most tags are tiny.
+_SPARSE_RATIO = 32
+
+@dataclass
+class FilterIndex:
+    """Row sets per component and per tag (bit i = BM25 row / FAISS position i).
+
+    Each set is either a packed bitmap (uint8) or, for rare values, sorted row ids (int32),
+    densified only while a filter is evaluated. Bits are little-endian within each byte,
+    which is the layout faiss.IDSelectorBitmap expects.
+    """
+    n: int
+    components: Dict[str, np.ndarray]
+    tags: Dict[str, np.ndarray]
+    scores: np.ndarray  # int32 record score per row, unpacked
+
+    @classmethod
+    def build(cls, docs: List[Document]) -> "FilterIndex":
+        n = len(docs)
+        comp_rows: Dict[str, List[int]] = {}
+        tag_rows: Dict[str, List[int]] = {}
+        scores = np.zeros(n, dtype=np.int32)
+        for i, d in enumerate(docs):
+            scores[i] = int(d.metadata.get("score") or 0)
+            comp = str(d.metadata.get("component", "")).lower()
+            if comp:
+                comp_rows.setdefault(comp, []).append(i)
+            for t in (d.metadata.get("tags") or []):
+                tag_rows.setdefault(str(t).lower(), []).append(i)
+        return cls(n=n,
+                   components={k: cls._pack(n, v) for k, v in comp_rows.items()},
+                   tags={k: cls._pack(n, v) for k, v in tag_rows.items()},
+                   scores=scores)
+
+    @staticmethod
+    def _pack(n: int, rows: List[int]) -> np.ndarray:
+        if len(rows) * _SPARSE_RATIO < n:
+            return np.unique(np.asarray(rows, dtype=np.int32))
+        mask = np.zeros(n, dtype=bool)
+        mask[rows] = True
+        return np.packbits(mask, bitorder="little")
+
+    def save(self, path: str):
+        p = Path(path)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        arrays = {"n": np.asarray([self.n], dtype=np.int64), "scores": self.scores}
+        arrays.update({f"c:{k}": v for k, v in self.components.items()})
+        arrays.update({f"t:{k}": v for k, v in self.tags.items()})
+        with open(p, "wb") as f:
+            np.savez_compressed(f, **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["FilterIndex"]:
+        """None if the file predates a field this version needs (caller rebuilds)."""
+        with np.load(path) as z:
+            if "scores" not in z.files:
+                return None
+            n = int(z["n"][0])
+            comps = {k[2:]: z[k] for k in z.files if k.startswith("c:")}
+            tags = {k[2:]: z[k] for k in z.files if k.startswith("t:")}
+            scores = z["scores"]
+        return cls(n=n, components=comps, tags=tags, scores=scores)
+
+    def _empty(self) -> np.ndarray:
+        return np.zeros((self.n + 7) // 8, dtype=np.uint8)
+
+    def _invert(self, bits: np.ndarray) -> np.ndarray:
+        out = np.invert(bits)
+        tail = self.n % 8
+        if tail:
+            out[-1] &= (1 << tail) - 1  # keep padding bits clear
+        return out
+
+    def _leaf(self, table: Dict[str, np.ndarray], names: List[str]) -> np.ndarray:
+        out = self._empty()
+        rows = []
+        for name in names:
+            entry = table.get(name.lower())
+            if entry is None:
+                continue
+            if entry.dtype == np.uint8:
+                np.bitwise_or(out, entry, out=out)
+            else:
+                rows.append(entry)
+        if rows:
+            mask = np.zeros(self.n, dtype=bool)
+            for r in rows:
+                mask[r] = True
+            np.bitwise_or(out, np.packbits(mask, bitorder="little"), out=out)
+        return out
+
+    def evaluate(self, expr: FilterExpr) -> np.ndarray:
+        """Evaluate a filter expression to a packed bitmap; FilterError for malformed expressions."""
+        op, arg = filter_node(expr)
+        if op == "component":
+            return self._leaf(self.components, arg)
+        if op == "tag":
+            return self._leaf(self.tags, arg)
+        if op == "min_score":
+            return np.packbits(self.scores >= arg, bitorder="little")
+        if op == "not":
+            return self._invert(self.evaluate(arg))
+        if op in ("and", "or"):
+            out = self.evaluate(arg[0]).copy()
+            fn = np.bitwise_and if op == "and" else np.bitwise_or
+            for sub in arg[1:]:
+                fn(out, self.evaluate(sub), out=out)
+            return out
+
+    @staticmethod
+    def matches(expr: FilterExpr, metadata: Dict[str, Any]) -> bool:
+        """Evaluate a filter expression against one chunk's metadata (hits that carry no row id)."""
+        op, arg = filter_node(expr)
+        if op == "component":
+            return str(metadata.get("component", "")).lower() in {x.lower() for x in arg}
+        if op == "tag":
+            return bool({x.lower() for x in arg} & {str(t).lower() for t in (metadata.get("tags") or [])})
+        if op == "min_score":
+            return int(metadata.get("score") or 0) >= arg
+        if op == "not":
+            return not FilterIndex.matches(arg, metadata)
+        fn = all if op == "and" else any
+        return fn(FilterIndex.matches(sub, metadata) for sub in arg)
+
+    @staticmethod
+    def expr_for(components: Optional[List[str]], tags: Optional[List[str]],
+                 where: Optional[FilterExpr] = None, min_score: Optional[int] = None) -> Optional[FilterExpr]:
+        """AND of (any component) / (any tag) / min_score / `where`, or None when nothing filters."""
+        parts: List[FilterExpr] = []
+        if components:
+            parts.append({"component": list(components)})
+        if tags:
+            parts.append({"tag": list(tags)})
+        if min_score is not None:
+            parts.append({"min_score": int(min_score)})
+        if where:
+            parts.append(where)
+        if not parts:
+            return None
+        return parts[0] if len(parts) == 1 else {"and": parts}
+
+    def to_mask(self, bits: np.ndarray) -> np.ndarray:
+        return np.unpackbits(bits, count=self.n, bitorder="little").view(bool)
@@ -1,52 +1,163 @@
 from __future__ import annotations
 
+import time
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
 
+import numpy as np
 from langchain_core.documents import Document
 
+from rag.admission import stage
 from rag.config import settings
+from rag.retrievers.filter_index import FilterError, FilterExpr, FilterIndex
 from rag.retrievers.persistent_bm25 import PersistentBM25
 
 def _doc_key(d: Document) -> str:
     md = d.metadata or {}
     return f"{md.get('qid','')}-{md.get('chunk_id','')}-{md.get('title','')[:80]}"
 
+def _doc_ids(hits: List[Tuple[Document, float]], legacy: Dict[str, int], keyed: bool) -> np.ndarray:
+    """Integer identities; with `keyed` (some hit has no doc_id, e.g. an index or Milvus collection built
+    before doc_id existed) every chunk gets a per-call negative id from its key, so lists still match."""
+    out = np.empty(len(hits), dtype=np.int64)
+    for i, (d, _) in enumerate(hits):
+        out[i] = legacy.setdefault(_doc_key(d), -1 - len(legacy)) if keyed else d.metadata["doc_id"]
+    return out
+
 def rrf_fuse(
-    dense: List[Tuple[Document, float]],
-    sparse: List[Tuple[Document, float]],
+    ranked: Sequence[List[Tuple[Document, float]]],
     k: int,
     c: int,
+    weights: Optional[Sequence[float]] = None,
+    debug: bool = False,
 ) -> Tuple[List[Tuple[Document, float]], Dict]:
-    # Reciprocal Rank Fusion: score(d)=sum_i 1/(rank_i(d)+c)
-    rrf: Dict[str, float] = {}
-    doc_by_id: Dict[str, Document] = {}
-
-    for rank, (d, _) in enumerate(dense, start=1):
-        key = _doc_key(d)
-        doc_by_id[key] = d
-        rrf[key] = rrf.get(key, 0.0) + 1.0 / (rank + c)
-
-    for rank, (d, _) in enumerate(sparse, start=1):
-        key = _doc_key(d)
-        doc_by_id[key] = d
-        rrf[key] = rrf.get(key, 0.0) + 1.0 / (rank + c)
-
-    fused_items = sorted(rrf.items(), key=lambda kv: kv[1], reverse=True)[:k]
-    fused = [(doc_by_id[key], score) for key, score in fused_items]
-
-    debug = {
-        "dense_n": len(dense),
-        "bm25_n": len(sparse),
-        "rrf_c": c,
-        "rrf_top": [{"key": key, "rrf": float(score)} for key, score in fused_items],
-    }
-    return fused, debug
+    # Weighted Reciprocal Rank Fusion: score(d)=sum_i w_i/(rank_i(d)+c), over any number of ranked lists
+    legacy: Dict[str, int] = {}
+    keyed = any((d.metadata or {}).get("doc_id") is None for hits in ranked for d, _ in hits)
+    all_docs: List[Document] = []
+    ids_parts, contrib_parts = [], []
+    for li, hits in enumerate(ranked):
+        if not hits:
+            continue
+        w = 1.0 if weights is None else float(weights[li])
+        ids_parts.append(_doc_ids(hits, legacy, keyed))
+        contrib_parts.append(w / (np.arange(1, len(hits) + 1, dtype=np.float64) + c))
+        all_docs.extend(d for d, _ in hits)
+
+    info: Dict = {"n": [len(h) for h in ranked], "rrf_c": c}
+    if not all_docs:
+        if debug:
+            info["rrf_top"] = []
+        return [], info
+
+    ids = np.concatenate(ids_parts)
+    uniq, inv = np.unique(ids, return_inverse=True)
+    scores = np.bincount(inv, weights=np.concatenate(contrib_parts))
+    # first position of each id in the concatenated lists: ties keep retriever/rank order
+    first = np.full(len(uniq), len(ids), dtype=np.int64)
+    np.minimum.at(first, inv, np.arange(len(ids)))
+    order = np.lexsort((first, -scores))[:k]
+
+    fused = [(all_docs[first[j]], float(scores[j])) for j in order]
+    if debug:
+        info["rrf_top"] = [{"doc_id": int(uniq[j]),
+                            "qid": all_docs[first[j]].metadata.get("qid"),
+                            "chunk_id": all_docs[first[j]].metadata.get("chunk_id"),
+                            "rrf": float(scores[j])} for j in order]
+    return fused, info
 
 class HybridRetriever:
-    def __init__(self, vectorstore, bm25: PersistentBM25):
+    def __init__(self, vectorstore, bm25: PersistentBM25, filters: Optional[FilterIndex] = None,
+                 backend: Optional[str] = None):
+        self.backend = backend or settings.vector_backend
         self.vectorstore = vectorstore
         self.bm25 = bm25
+        self.filters = filters if filters is not None else FilterIndex.build(bm25.index.docs)
+
+    @property
+    def embeddings(self):
+        return self.vectorstore.embeddings
+
+    def filter_mask(
+        self,
+        components: Optional[List[str]],
+        tags: Optional[List[str]],
+        where: Optional[FilterExpr] = None,
+        min_score: Optional[int] = None,
+    ) -> Optional[np.ndarray]:
+        """Bool mask over rows (BM25 row == FAISS position), or None when unfiltered."""
+        expr = FilterIndex.expr_for(components, tags, where, min_score)
+        if expr is None:
+            return None
+        return self.filters.to_mask(self.filters.evaluate(expr))
+
+    def _milvus_expr(
+        self,
+        components: Optional[List[str]],
+        tags: Optional[List[str]],
+        where: Optional[FilterExpr],
+        min_score: Optional[int],
+    ) -> Optional[str]:
+        """Push the whole filter into Milvus when the collection has typed columns for it."""
+        fields = getattr(self.vectorstore, "fields", None)
+        if fields is not None:
+            from rag.vectorstores.milvus_store import milvus_filter_expr
+            try:
+                return milvus_filter_expr(FilterIndex.expr_for(components, tags, where, min_score), fields)
+            except FilterError:
+                pass
+        # Component-only pushdown; the rest is post-filtered.
+        expr_parts = []
+        if components:
+            comps = ",".join([f'"{c}"' for c in components])
+            expr_parts.append(f'component in [{comps}]')
+        return " and ".join(expr_parts) if expr_parts else None
+
+    @staticmethod
+    def _post_filter(
+        dense: List[Tuple[Document, float]],
+        k: int,
+        components: Optional[List[str]],
+        tags: Optional[List[str]],
+        mask: Optional[np.ndarray] = None,
+        min_score: Optional[int] = None,
+        where: Optional[FilterExpr] = None,
+    ) -> List[Tuple[Document, float]]:
+        if mask is not None and all("doc_id" in d.metadata for d, _ in dense):
+            return [(d, s) for d, s in dense if mask[d.metadata["doc_id"]]][:k]
+        # Hits without row ids (legacy Milvus collections): evaluate the filter on their metadata.
+        expr = FilterIndex.expr_for(components, tags, where, min_score)
+        if expr is not None:
+            dense = [(d, s) for d, s in dense if FilterIndex.matches(expr, d.metadata)]
+        return dense[:k]
+
+    def _faiss_search(
+        self,
+        vectors: Sequence[Sequence[float]],
+        fetch_k: int,
+        mask: Optional[np.ndarray],
+    ) -> List[List[Tuple[Document, float]]]:
+        """One matrix search; `mask` is applied inside FAISS through an IDSelectorBitmap."""
+        import faiss
+
+        vs = self.vectorstore
+        x = np.asarray(vectors, dtype=np.float32)
+        if getattr(vs, "_normalize_L2", False):
+            faiss.normalize_L2(x)
+        if mask is None:
+            dist, ids = vs.index.search(x, fetch_k)
+        else:
+            sel = faiss.IDSelectorBitmap(np.packbits(mask, bitorder="little"))
+            dist, ids = vs.index.search(x, fetch_k, params=faiss.SearchParameters(sel=sel))
+        results = []
+        for row_d, row_i in zip(dist, ids):
+            hits = []
+            for s, i in zip(row_d, row_i):
+                if i == -1:
+                    continue
+                hits.append((vs.docstore.search(vs.index_to_docstore_id[int(i)]), float(s)))
+            results.append(hits)
+        return results
 
     def dense_search(
         self,
@@ -55,41 +166,75 @@ class HybridRetriever:
         fetch_k: int,
         components: Optional[List[str]],
         tags: Optional[List[str]],
+        mask: Optional[np.ndarray] = None,
+        where: Optional[FilterExpr] = None,
+        min_score: Optional[int] = None,
     ) -> List[Tuple[Document, float]]:
-        backend = settings.vector_backend
+        backend = self.backend
 
-        # Milvus: try expr for component filter, tags post-filter (expr syntax differs across versions)
+        # Milvus: filters pushed into expr where the schema allows, post-filter for the rest
         if backend == "milvus":
-            expr_parts = []
-            if components:
-                comps = ",".join([f'"{c}"' for c in components])
-                expr_parts.append(f'component in [{comps}]')
-            expr = " and ".join(expr_parts) if expr_parts else None
+            expr = self._milvus_expr(components, tags, where, min_score)
+            with stage("embedding"):
+                vector = self.vectorstore.embeddings.embed_query(query)
+            docs_scores = self.vectorstore.similarity_search_with_score_by_vector(vector, k=fetch_k, expr=expr)
+            dense = [(d, float(s)) for d, s in docs_scores]
+        else:
+            with stage("embedding"):
+                vector = self.vectorstore.embeddings.embed_query(query)
+            dense = self._faiss_search([vector], fetch_k, mask)[0]
 
-            try:
-                kwargs = {"k": fetch_k}
-                if expr:
-                    kwargs["expr"] = expr
-                docs_scores = self.vectorstore.similarity_search_with_score(query, **kwargs)
-            except TypeError:
-                docs_scores = self.vectorstore.similarity_search_with_score(
-                    query, k=fetch_k, search_kwargs={"expr": expr} if expr else {}
-                )
+        return self._post_filter(dense, k, components, tags, mask, min_score, where)
 
-            dense = [(d, float(s)) for d, s in docs_scores]
+    def dense_search_batch(
+        self,
+        queries: Sequence[str],
+        k: int,
+        fetch_k: int,
+        components: Optional[List[str]],
+        tags: Optional[List[str]],
+        mask: Optional[np.ndarray] = None,
+        where: Optional[FilterExpr] = None,
+        min_score: Optional[int] = None,
+        vectors: Optional[Sequence[Sequence[float]]] = None,
+    ) -> List[List[Tuple[Document, float]]]:
+        """Embed all queries in one call (unless `vectors` are given) and, for FAISS, search them as one matrix."""
+        if vectors is None:
+            with stage("embedding"):
+                vectors = self.vectorstore.embeddings.embed_documents(list(queries))
+
+        if self.backend == "milvus":
+            expr = self._milvus_expr(components, tags, where, min_score)
+            kwargs = {"k": fetch_k}
+            if expr:
+                kwargs["expr"] = expr
+            if hasattr(self.vectorstore, "similarity_search_with_score_by_vectors"):
+                results = self.vectorstore.similarity_search_with_score_by_vectors(vectors, **kwargs)
+            else:
+                results = [self.vectorstore.similarity_search_with_score_by_vector(v, **kwargs) for v in vectors]
         else:
-            docs_scores = self.vectorstore.similarity_search_with_score(query, k=fetch_k)
-            dense = [(d, float(s)) for d, s in docs_scores]
+            results = self._faiss_search(vectors, fetch_k, mask)
 
-        # Post-filter
-        if components:
-            cset = set([c.lower() for c in components])
-            dense = [(d, s) for d, s in dense if str(d.metadata.get("component","")).lower() in cset]
-        if tags:
-            tset = set([t.lower() for t in tags])
-            dense = [(d, s) for d, s in dense if tset.intersection(set([x.lower() for x in (d.metadata.get("tags") or [])]))]
+        return [self._post_filter([(d, float(s)) for d, s in r], k, components, tags, mask, min_score, where)
+                for r in results]
 
-        return dense[:k]
+    @staticmethod
+    def _fuse(
+        dense: List[Tuple[Document, float]],
+        sparse: List[Tuple[Document, float]],
+        top_k: int,
+        debug: bool,
+    ) -> Tuple[List[Tuple[Document, float]], Dict]:
+        fused, fuse_info = rrf_fuse([dense, sparse], k=top_k, c=settings.rrf_c,
+                                    weights=[settings.rrf_dense_weight, settings.rrf_bm25_weight], debug=debug)
+        info = {"dense_n": len(dense), "bm25_n": len(sparse), "rrf_c": settings.rrf_c}
+        if debug:
+            info.update({
+                "rrf_top": fuse_info["rrf_top"],
+                "dense_preview": [{"title": d.metadata.get("title",""), "component": d.metadata.get("component","")} for d, _ in dense[:3]],
+                "bm25_preview": [{"title": d.metadata.get("title",""), "component": d.metadata.get("component","")} for d, _ in sparse[:3]],
+            })
+        return fused, info
 
     def retrieve(
         self,
@@ -98,13 +243,54 @@ class HybridRetriever:
         fetch_k: int,
         components: Optional[List[str]] = None,
         tags: Optional[List[str]] = None,
+        debug: bool = False,
+        where: Optional[FilterExpr] = None,
+        min_score: Optional[int] = None,
     ) -> Tuple[List[Tuple[Document, float]], Dict]:
-        dense = self.dense_search(query, k=top_k, fetch_k=fetch_k, components=components, tags=tags)
-        sparse = self.bm25.search(query, k=top_k, components=components, tags=tags)
-        fused, debug = rrf_fuse(dense, sparse, k=top_k, c=settings.rrf_c)
-
-        debug.update({
-            "dense_preview": [{"title": d.metadata.get("title",""), "component": d.metadata.get("component","")} for d, _ in dense[:3]],
-            "bm25_preview": [{"title": d.metadata.get("title",""), "component": d.metadata.get("component","")} for d, _ in sparse[:3]],
-        })
-        return fused, debug
+        t0 = time.perf_counter()
+        mask = self.filter_mask(components, tags, where, min_score)
+        t1 = time.perf_counter()
+        dense = self.dense_search(query, k=top_k, fetch_k=fetch_k, components=components, tags=tags, mask=mask,
+                                  where=where, min_score=min_score)
+        t2 = time.perf_counter()
+        sparse = self.bm25.search(query, k=top_k, mask=mask)
+        t3 = time.perf_counter()
+        fused, info = self._fuse(dense, sparse, top_k, debug)
+        if debug:
+            info["timings_ms"] = {"filter_ms": (t1 - t0) * 1000, "dense_ms": (t2 - t1) * 1000,
+                                  "bm25_ms": (t3 - t2) * 1000, "fuse_ms": (time.perf_counter() - t3) * 1000}
+            info["filter_rows"] = None if mask is None else int(mask.sum())
+        return fused, info
+
+    def retrieve_batch(
+        self,
+        queries: Sequence[str],
+        top_k: int,
+        fetch_k: int,
+        components: Optional[List[str]] = None,
+        tags: Optional[List[str]] = None,
+        debug: bool = False,
+        where: Optional[FilterExpr] = None,
+        min_score: Optional[int] = None,
+    ) -> List[Tuple[List[Tuple[Document, float]], Dict]]:
+        ranked = self.search_lists(queries, top_k=top_k, fetch_k=fetch_k, components=components, tags=tags,
+                                   where=where, min_score=min_score)
+        return [self._fuse(dense, sparse, top_k, debug) for dense, sparse in ranked]
+
+    def search_lists(
+        self,
+        queries: Sequence[str],
+        top_k: int,
+        fetch_k: int,
+        components: Optional[List[str]] = None,
+        tags: Optional[List[str]] = None,
+        where: Optional[FilterExpr] = None,
+        min_score: Optional[int] = None,
+        vectors: Optional[Sequence[Sequence[float]]] = None,
+    ) -> List[Tuple[List[Tuple[Document, float]], List[Tuple[Document, float]]]]:
+        """Unfused (dense, bm25) top lists per query; what a shard returns to the scatter/gather router."""
+        mask = self.filter_mask(components, tags, where, min_score)
+        dense_all = self.dense_search_batch(queries, k=top_k, fetch_k=fetch_k, components=components, tags=tags,
+                                            mask=mask, where=where, min_score=min_score, vectors=vectors)
+        sparse_all = self.bm25.search_batch(queries, k=top_k, mask=mask)
+        return list(zip(dense_all, sparse_all))
@@ -1,48 +1,125 @@
 from __future__ import annotations
 
 import pickle
-import re
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import List, Optional, Sequence, Tuple
 
+import numpy as np
 from langchain_core.documents import Document
-from rank_bm25 import BM25Okapi
 
-TOKEN_RE = re.compile(r"[A-Za-z0-9_\.\#/-]+|[\u4e00-\u9fff]+")
+from rag.retrievers.tokenizer import TOKEN_RE, TermTokenizer, default_tokenize  # noqa: F401 (re-exported)
 
-def default_tokenize(text: str) -> List[str]:
-    return TOKEN_RE.findall(text.lower())
+# BM25Okapi parameters (same defaults and idf floor as rank_bm25).
+K1, B, EPSILON = 1.5, 0.75, 0.25
+
+# Cap on the dense (queries x docs) float64 score block used by search_batch.
+_BATCH_SCORE_CELLS = 1 << 25
+
+@dataclass
+class Postings:
+    """CSR postings: term id t owns rows/weights[indptr[t]:indptr[t + 1]].
+
+    Each weight is the term's full BM25 contribution to that document, so
+    scoring a query only touches the documents that contain its terms.
+    """
+    indptr: np.ndarray   # int64, n_terms + 1
+    rows: np.ndarray     # int32 doc rows, ascending within a term
+    weights: np.ndarray  # float32
+
+    @classmethod
+    def build(cls, encoded: List[np.ndarray], n_terms: int, stats: Optional["CorpusStats"] = None) -> "Postings":
+        """`stats` replaces this document set's idf / avgdl with corpus-wide ones (shards)."""
+        n = len(encoded)
+        doc_len = np.fromiter((len(e) for e in encoded), dtype=np.int64, count=n)
+        if n == 0 or n_terms == 0:
+            return cls(np.zeros(n_terms + 1, dtype=np.int64), np.empty(0, dtype=np.int32),
+                       np.empty(0, dtype=np.float32))
+        terms = np.concatenate(encoded).astype(np.int64)
+        docs = np.repeat(np.arange(n, dtype=np.int64), doc_len)
+        pairs, tf = np.unique(terms * n + docs, return_counts=True)  # sorted by (term, doc)
+        term, row = pairs // n, pairs % n
+
+        df = np.bincount(term, minlength=n_terms)
+        if stats is None:
+            idf, avgdl = _idf(df, n), doc_len.mean() or 1.0
+        else:
+            idf, avgdl = stats.idf, stats.avgdl
+        norm = K1 * (1 - B + B * doc_len / avgdl)
+        tf = tf.astype(np.float64)
+        weights = idf[term] * tf * (K1 + 1) / (tf + norm[row])
+
+        indptr = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum(df, out=indptr[1:])
+        return cls(indptr, row.astype(np.int32), weights.astype(np.float32))
+
+    def positions(self, term_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Flat positions of every posting of `term_ids` (repeats included), and the count per term."""
+        starts = self.indptr[term_ids]
+        lens = self.indptr[term_ids + 1] - starts
+        total = int(lens.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.int64), lens
+        offsets = starts - (np.cumsum(lens) - lens)
+        return np.repeat(offsets, lens) + np.arange(total, dtype=np.int64), lens
+
+def _idf(df: np.ndarray, n: int) -> np.ndarray:
+    idf = np.log(n - df + 0.5) - np.log(df + 0.5)
+    idf[idf < 0] = EPSILON * idf.mean()
+    return idf
+
+@dataclass
+class CorpusStats:
+    """Vocabulary, idf and average length of a whole corpus.
+
+    Shards built with the same stats score a document exactly as the
+    unsharded index would, so their BM25 lists are comparable.
+    """
+    tokenizer: TermTokenizer
+    idf: np.ndarray
+    avgdl: float
+
+    @classmethod
+    def fit(cls, docs: Sequence[Document], cjk_ngram: Optional[int] = None) -> Tuple["CorpusStats", List[np.ndarray]]:
+        """Returns (stats, term ids per document)."""
+        tokenizer, encoded = TermTokenizer.fit((d.page_content for d in docs), cjk_ngram)
+        n_terms = len(tokenizer.vocab)
+        df = np.zeros(n_terms, dtype=np.int64)
+        for e in encoded:
+            df[np.unique(e)] += 1
+        avgdl = float(np.mean([len(e) for e in encoded])) if encoded else 0.0
+        return cls(tokenizer, _idf(df, len(encoded)), avgdl or 1.0), encoded
 
 @dataclass
 class BM25Index:
     docs: List[Document]
-    tokenized_corpus: List[List[str]]
-    bm25: BM25Okapi
-    by_component: Dict[str, List[int]]
-    by_tag: Dict[str, List[int]]
+    tokenizer: TermTokenizer  # frozen vocabulary + CJK n-gram size used at build time
+    postings: Postings
+
+def _top_k(scores: np.ndarray, k: int, mask: Optional[np.ndarray]) -> np.ndarray:
+    if mask is not None:
+        scores = np.where(mask, scores, 0.0)
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind="stable")]
+    return top[scores[top] > 0]
 
 class PersistentBM25:
     def __init__(self, index: BM25Index):
         self.index = index
 
     @classmethod
-    def build(cls, docs: List[Document], tokenize_fn=default_tokenize) -> "PersistentBM25":
-        tokenized = [tokenize_fn(d.page_content) for d in docs]
-        bm25 = BM25Okapi(tokenized)
-
-        by_component: Dict[str, List[int]] = {}
-        by_tag: Dict[str, List[int]] = {}
-        for i, d in enumerate(docs):
-            comp = str(d.metadata.get("component", "")).lower()
-            if comp:
-                by_component.setdefault(comp, []).append(i)
-            for t in (d.metadata.get("tags") or []):
-                tl = str(t).lower()
-                by_tag.setdefault(tl, []).append(i)
-
-        return cls(BM25Index(docs=docs, tokenized_corpus=tokenized, bm25=bm25,
-                            by_component=by_component, by_tag=by_tag))
+    def build(cls, docs: List[Document], cjk_ngram: Optional[int] = None,
+              stats: Optional[CorpusStats] = None, encoded: Optional[List[np.ndarray]] = None) -> "PersistentBM25":
+        """With `stats` (and the docs' `encoded` term ids from CorpusStats.fit), build one shard of that corpus."""
+        if stats is None:
+            tokenizer, encoded = TermTokenizer.fit((d.page_content for d in docs), cjk_ngram)
+        else:
+            tokenizer = stats.tokenizer
+        return cls(BM25Index(docs=docs, tokenizer=tokenizer,
+                             postings=Postings.build(encoded, len(tokenizer.vocab), stats)))
 
     def save(self, path: str):
         p = Path(path)
@@ -54,42 +131,70 @@ class PersistentBM25:
     def load(cls, path: str) -> "PersistentBM25":
         with open(path, "rb") as f:
             idx = pickle.load(f)
+        if not isinstance(getattr(idx, "postings", None), Postings):
+            # Index pickled before term-id postings (rank_bm25 string dicts); re-tokenize its documents.
+            return cls.build(idx.docs)
+        # Pickles from before FilterIndex also carry per-component/tag row lists; filters no longer read them.
+        idx.__dict__.pop("by_component", None)
+        idx.__dict__.pop("by_tag", None)
         return cls(idx)
 
-    def _subset_indices(self, components: Optional[List[str]], tags: Optional[List[str]]) -> Optional[List[int]]:
-        sets: List[set] = []
-        if components:
-            cset = set()
-            for c in components:
-                cset |= set(self.index.by_component.get(c.lower(), []))
-            sets.append(cset)
-        if tags:
-            tset = set()
-            for t in tags:
-                tset |= set(self.index.by_tag.get(t.lower(), []))
-            sets.append(tset)
-        if not sets:
-            return None
-        inter = sets[0]
-        for s in sets[1:]:
-            inter &= s
-        return sorted(inter)
+    @property
+    def tokenizer(self) -> TermTokenizer:
+        return self.index.tokenizer
+
+    def _encode(self, query: str, tokenize_fn=None) -> np.ndarray:
+        if tokenize_fn is None:
+            return self.tokenizer.encode_query(query)
+        return self.tokenizer.encode(tokenize_fn(query))
+
+    def get_scores(self, term_ids: np.ndarray) -> np.ndarray:
+        p = self.index.postings
+        pos, _ = p.positions(term_ids)
+        return np.bincount(p.rows[pos], weights=p.weights[pos], minlength=len(self.index.docs))
 
     def search(
         self,
         query: str,
         k: int = 8,
-        components: Optional[List[str]] = None,
-        tags: Optional[List[str]] = None,
-        tokenize_fn=default_tokenize,
+        tokenize_fn=None,
+        mask: Optional[np.ndarray] = None,
     ) -> List[Tuple[Document, float]]:
-        qtok = tokenize_fn(query)
-        subset = self._subset_indices(components, tags)
-        scores = self.index.bm25.get_scores(qtok)
+        """`mask` (bool per row, from FilterIndex) restricts the candidates.
 
-        if subset is None:
-            top_idx = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:k]
-        else:
-            top_idx = sorted(subset, key=lambda i: scores[i], reverse=True)[:k]
+        `tokenize_fn` overrides the index tokenizer (terms still go through its vocabulary).
+        """
+        scores = self.get_scores(self._encode(query, tokenize_fn))
+        top_idx = _top_k(scores, k, mask)
+        return [(self.index.docs[i], float(scores[i])) for i in top_idx]
+
+    def search_batch(
+        self,
+        queries: Sequence[str],
+        k: int = 8,
+        tokenize_fn=None,
+        mask: Optional[np.ndarray] = None,
+    ) -> List[List[Tuple[Document, float]]]:
+        """Score many queries at once.
+
+        The postings of all queries in a block are gathered in one pass and
+        summed into a (queries x docs) matrix with a single bincount.
+        """
+        n_docs = len(self.index.docs)
+        encoded = [self._encode(q, tokenize_fn) for q in queries]
+        block = max(1, _BATCH_SCORE_CELLS // max(n_docs, 1))
+        p = self.index.postings
 
-        return [(self.index.docs[i], float(scores[i])) for i in top_idx if scores[i] > 0]
+        out: List[List[Tuple[Document, float]]] = []
+        for start in range(0, len(encoded), block):
+            part = encoded[start:start + block]
+            term_ids = np.concatenate(part) if part else np.empty(0, dtype=np.int32)
+            qrow = np.repeat(np.arange(len(part), dtype=np.int64), [len(e) for e in part])
+            pos, lens = p.positions(term_ids)
+            flat = np.repeat(qrow, lens) * n_docs + p.rows[pos]
+            scores = np.bincount(flat, weights=p.weights[pos], minlength=len(part) * n_docs)
+            scores = scores.reshape(len(part), n_docs)
+            for row in range(len(part)):
+                top_idx = _top_k(scores[row], k, mask)
+                out.append([(self.index.docs[i], float(scores[row, i])) for i in top_idx])
+        return out
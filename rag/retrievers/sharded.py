@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from rag.admission import Overloaded, stage
+from rag.config import settings
+from rag.index import load_bm25, load_filters, load_vectorstore, shard_dir
+from rag.metrics import metrics
+from rag.retrievers.filter_index import FilterError, FilterExpr
+from rag.retrievers.hybrid_rrf import HybridRetriever
+
+Ranked = List[Tuple[Document, float]]
+
+class VectorsOnly(Embeddings):
+    """Embeddings stand-in for shards: the router embeds each query once and sends the vector."""
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        raise RuntimeError("shards search by vector; queries are embedded by the router")
+
+    def embed_query(self, text: str) -> List[float]:
+        raise RuntimeError("shards search by vector; queries are embedded by the router")
+
+def load_shard_retriever(index_dir: str) -> HybridRetriever:
+    # Sharded builds are FAISS only, whatever VECTOR_BACKEND the router runs with.
+    vs = load_vectorstore(index_dir, embeddings=VectorsOnly(), backend="faiss")
+    bm25 = load_bm25(index_dir)
+    return HybridRetriever(vs, bm25, filters=load_filters(index_dir, bm25), backend="faiss")
+
+def _relabel(hits: Ranked, shard: str, offset: int) -> Ranked:
+    # Local doc ids (row == FAISS position) become global ids, unique across shards, for RRF identity.
+    return [(Document(page_content=d.page_content,
+                      metadata={**d.metadata, "doc_id": offset + int(d.metadata["doc_id"]), "shard": shard}), s)
+            for d, s in hits]
+
+def shard_search(retriever: HybridRetriever, shard: str, offset: int, queries: Sequence[str],
+                 vectors: Sequence[Sequence[float]], **kwargs) -> List[Tuple[Ranked, Ranked]]:
+    """Per-query (dense, bm25) top lists of one shard, with global doc ids."""
+    lists = retriever.search_lists(queries, vectors=vectors, **kwargs)
+    return [(_relabel(dense, shard, offset), _relabel(sparse, shard, offset)) for dense, sparse in lists]
+
+def encode_hits(hits: Ranked) -> List[Dict[str, Any]]:
+    return [{"page_content": d.page_content, "metadata": d.metadata, "score": s} for d, s in hits]
+
+def decode_hits(items: List[Dict[str, Any]]) -> Ranked:
+    return [(Document(page_content=x["page_content"], metadata=x["metadata"]), float(x["score"])) for x in items]
+
+class LocalShard:
+    """Shard loaded in this process (no SHARD_URLS entry)."""
+
+    def __init__(self, name: str, doc_offset: int, components: List[str], retriever: HybridRetriever):
+        self.name = name
+        self.doc_offset = doc_offset
+        self.components = components
+        self.retriever = retriever
+
+    def search(self, version: str, queries: Sequence[str], vectors: Sequence[Sequence[float]],
+               **kwargs) -> List[Tuple[Ranked, Ranked]]:
+        return shard_search(self.retriever, self.name, self.doc_offset, queries, vectors, **kwargs)
+
+class RemoteShard:
+    """Shard behind `scripts.cli shard-serve`; it answers 409 when it serves another index version."""
+
+    def __init__(self, name: str, doc_offset: int, components: List[str], url: str):
+        import httpx
+
+        self.name = name
+        self.doc_offset = doc_offset
+        self.components = components
+        self.url = url
+        self.client = httpx.Client(base_url=url, timeout=settings.shard_timeout_seconds)
+
+    def search(self, version: str, queries: Sequence[str], vectors: Sequence[Sequence[float]],
+               **kwargs) -> List[Tuple[Ranked, Ranked]]:
+        body = {"version": version, "queries": list(queries),
+                "vectors": [[float(x) for x in v] for v in vectors], **kwargs}
+        r = self.client.post("/retrieve", json=body)
+        if r.status_code == 400:
+            raise FilterError(r.json().get("detail", r.text))
+        r.raise_for_status()
+        return [(decode_hits(x["dense"]), decode_hits(x["sparse"])) for x in r.json()["results"]]
+
+def parse_shard_urls(spec: str) -> Dict[str, str]:
+    """"spark=http://10.0.0.5:8101,kafka=http://10.0.0.6:8101" -> {name: url}."""
+    out = {}
+    for item in filter(None, (x.strip() for x in spec.split(","))):
+        name, sep, url = item.partition("=")
+        if not sep or not url:
+            raise ValueError(f"SHARD_URLS entry must be name=url: {item!r}")
+        out[name.strip()] = url.strip().rstrip("/")
+    return out
+
+class ShardedRetriever:
+    """Scatter/gather over the shards of one index version.
+
+    Queries are embedded once here; the shards that can hold matches (all of
+    them unless components are filtered) are searched in parallel; the shards'
+    dense and BM25 hits are merged into one global top list each, which are
+    fused with weighted RRF exactly like an unsharded HybridRetriever. Shards that
+    fail or miss SHARD_TIMEOUT_SECONDS are left out and reported in debug.
+    """
+
+    def __init__(self, shards: List[Any], embeddings, version: str):
+        self.shards = shards
+        self.embeddings = embeddings
+        self.version = version
+        workers = max(settings.shard_workers, len(shards))
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="shard")
+        # A timed-out local search cannot be cancelled and keeps its pool thread. Once a shard holds
+        # its share of the pool in such searches it is skipped, so one stuck shard cannot starve the rest.
+        self._per_shard = max(1, workers // max(1, len(shards)))
+        self._stuck = {s.name: 0 for s in shards}
+        self._stuck_lock = threading.Lock()
+
+    def _orphan(self, fut, name: str):
+        def _release(_):
+            with self._stuck_lock:
+                self._stuck[name] -= 1
+
+        with self._stuck_lock:
+            self._stuck[name] += 1
+        fut.add_done_callback(_release)
+
+    def _select(self, components: Optional[List[str]]) -> List[Any]:
+        if not components:
+            return self.shards
+        want = {c.lower() for c in components}
+        return [s for s in self.shards if want.intersection(s.components)]
+
+    def _gather(self, queries: Sequence[str], vectors: Sequence[Sequence[float]], top_k: int, fetch_k: int,
+                components: Optional[List[str]], tags: Optional[List[str]], debug: bool,
+                where: Optional[FilterExpr], min_score: Optional[int]) -> List[Tuple[Ranked, Dict]]:
+        t0 = time.perf_counter()
+        kwargs = {"top_k": top_k, "fetch_k": fetch_k, "components": components, "tags": tags,
+                  "where": where, "min_score": min_score}
+        status: Dict[str, str] = {}
+        futures = {}
+        for shard in self._select(components):
+            if self._stuck[shard.name] >= self._per_shard:
+                status[shard.name] = "busy"
+                metrics.inc("shard_busy")
+                continue
+            futures[self._pool.submit(shard.search, self.version, queries, vectors, **kwargs)] = shard
+        done, _ = wait(futures, timeout=settings.shard_timeout_seconds)
+        t1 = time.perf_counter()
+
+        merged: List[Tuple[Ranked, Ranked]] = [([], []) for _ in queries]
+        for fut, shard in futures.items():
+            if fut not in done:
+                if not fut.cancel():
+                    self._orphan(fut, shard.name)
+                status[shard.name] = "timeout"
+                metrics.inc("shard_timeouts")
+                continue
+            try:
+                results = fut.result()
+            except FilterError:
+                raise  # the request's filter is malformed, not the shard
+            except Exception as e:
+                status[shard.name] = f"{type(e).__name__}: {e}"
+                metrics.inc("shard_errors")
+                continue
+            status[shard.name] = "ok"
+            for (dense_all, sparse_all), (dense, sparse) in zip(merged, results):
+                dense_all.extend(dense)
+                sparse_all.extend(sparse)
+        if status and "ok" not in status.values():
+            raise Overloaded("shards", 503, f"no shard answered: {status}")
+
+        out = []
+        for dense_all, sparse_all in merged:
+            # FAISS L2 distances and BM25 scores (corpus-wide idf) are comparable across shards, so each
+            # list is merged into the global top-k first; fusing per-shard lists would give every shard's
+            # rank-1 hit the same RRF credit however weak its match.
+            dense = sorted(dense_all, key=lambda h: (h[1], h[0].metadata["doc_id"]))[:top_k]
+            sparse = sorted(sparse_all, key=lambda h: (-h[1], h[0].metadata["doc_id"]))[:top_k]
+            fused, info = HybridRetriever._fuse(dense, sparse, top_k, debug)
+            info.update({"shards": status, "partial": any(v != "ok" for v in status.values())})
+            if debug:
+                info["timings_ms"] = {"scatter_ms": (t1 - t0) * 1000, "fuse_ms": (time.perf_counter() - t1) * 1000}
+            out.append((fused, info))
+        return out
+
+    def retrieve(
+        self,
+        query: str,
+        top_k: int,
+        fetch_k: int,
+        components: Optional[List[str]] = None,
+        tags: Optional[List[str]] = None,
+        debug: bool = False,
+        where: Optional[FilterExpr] = None,
+        min_score: Optional[int] = None,
+    ) -> Tuple[Ranked, Dict]:
+        t0 = time.perf_counter()
+        with stage("embedding"):
+            vector = self.embeddings.embed_query(query)
+        embed_ms = (time.perf_counter() - t0) * 1000
+        fused, info = self._gather([query], [vector], top_k, fetch_k, components, tags, debug, where, min_score)[0]
+        if debug:
+            info["timings_ms"]["embed_ms"] = embed_ms
+        return fused, info
+
+    def retrieve_batch(
+        self,
+        queries: Sequence[str],
+        top_k: int,
+        fetch_k: int,
+        components: Optional[List[str]] = None,
+        tags: Optional[List[str]] = None,
+        debug: bool = False,
+        where: Optional[FilterExpr] = None,
+        min_score: Optional[int] = None,
+    ) -> List[Tuple[Ranked, Dict]]:
+        with stage("embedding"):
+            vectors = self.embeddings.embed_documents(list(queries))
+        return self._gather(queries, vectors, top_k, fetch_k, components, tags, debug, where, min_score)
+
+def load_sharded(index_dir: str, meta: Dict[str, Any], version: str) -> ShardedRetriever:
+    """Router over `meta["shards"]`: SHARD_URLS entries are remote, the other shards load in-process."""
+    from rag.embeddings import get_embeddings
+
+    urls = parse_shard_urls(settings.shard_urls)
+    shards: List[Any] = []
+    for s in meta["shards"]:
+        name, offset, components = s["shard"], int(s["doc_offset"]), list(s.get("components") or [])
+        if name in urls:
+            shards.append(RemoteShard(name, offset, components, urls[name]))
+        else:
+            shards.append(LocalShard(name, offset, components, load_shard_retriever(shard_dir(index_dir, name))))
+    return ShardedRetriever(shards, get_embeddings(), version)
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import re
+import time
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from rag.config import settings
+
+TOKEN_RE = re.compile(r"[A-Za-z0-9_\.\#/-]+|[\u4e00-\u9fff]+")
+CJK_RE = re.compile(r"[\u4e00-\u9fff]")
+
+def tokenize(text: str, cjk_ngram: int = 2) -> List[str]:
+    """Lowercased ASCII-ish words; CJK runs split into overlapping `cjk_ngram`-grams.
+
+    Runs shorter than n stay whole; cjk_ngram <= 0 keeps every run as one token.
+    """
+    out: List[str] = []
+    for tok in TOKEN_RE.findall(text.lower()):
+        n = cjk_ngram
+        if n <= 0 or len(tok) <= n or not CJK_RE.match(tok):
+            out.append(tok)
+        else:
+            out.extend(tok[i:i + n] for i in range(len(tok) - n + 1))
+    return out
+
+def default_tokenize(text: str) -> List[str]:
+    return tokenize(text, settings.bm25_cjk_ngram)
+
+class TermTokenizer:
+    """Maps text to int32 term ids through a vocabulary frozen at build time.
+
+    Query-time terms missing from the vocabulary are dropped (they match no
+    document). Query encodings go through a per-instance LRU cache.
+    """
+
+    def __init__(self, vocab: Dict[str, int], cjk_ngram: int):
+        self.vocab = vocab
+        self.cjk_ngram = cjk_ngram
+        self._init_cache()
+
+    def _init_cache(self):
+        self.encode_query = lru_cache(maxsize=max(0, settings.bm25_query_cache_size))(self._encode_query)
+
+    def __getstate__(self):
+        return {"vocab": self.vocab, "cjk_ngram": self.cjk_ngram}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_cache()
+
+    @classmethod
+    def fit(cls, texts: Iterable[str], cjk_ngram: Optional[int] = None) -> Tuple["TermTokenizer", List[np.ndarray]]:
+        """Build the vocabulary over `texts`; returns (tokenizer, term ids per text)."""
+        cjk_ngram = settings.bm25_cjk_ngram if cjk_ngram is None else cjk_ngram
+        vocab: Dict[str, int] = {}
+        encoded = []
+        for text in texts:
+            toks = tokenize(text, cjk_ngram)
+            encoded.append(np.fromiter((vocab.setdefault(t, len(vocab)) for t in toks),
+                                       dtype=np.int32, count=len(toks)))
+        return cls(vocab, cjk_ngram), encoded
+
+    def encode(self, tokens: Sequence[str]) -> np.ndarray:
+        vocab = self.vocab
+        return np.fromiter((vocab[t] for t in tokens if t in vocab), dtype=np.int32)
+
+    def _encode_query(self, text: str) -> np.ndarray:
+        ids = self.encode(tokenize(text, self.cjk_ngram))
+        ids.flags.writeable = False  # shared through the cache
+        return ids
+
+    def cache_info(self):
+        return self.encode_query.cache_info()
+
+def benchmark(texts: Sequence[str], queries: Sequence[str], cjk_ngram: int, rounds: int = 3) -> Dict[str, float]:
+    """Throughput of build-time (fit) and query-time (cold / cached) tokenization."""
+    n_chars = sum(len(t) for t in texts)
+    t0 = time.perf_counter()
+    tok, encoded = TermTokenizer.fit(texts, cjk_ngram)
+    fit_s = time.perf_counter() - t0
+    n_tokens = int(sum(len(e) for e in encoded))
+
+    cold = []
+    warm = []
+    for _ in range(rounds):
+        tok.encode_query.cache_clear()
+        t0 = time.perf_counter()
+        for q in queries:
+            tok.encode_query(q)
+        cold.append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        for q in queries:
+            tok.encode_query(q)
+        warm.append(time.perf_counter() - t0)
+    nq = max(len(queries), 1)
+    return {
+        "docs": len(texts),
+        "tokens": n_tokens,
+        "vocab": len(tok.vocab),
+        "fit_seconds": round(fit_s, 3),
+        "fit_docs_per_s": round(len(texts) / fit_s, 1) if fit_s else 0.0,
+        "fit_mb_per_s": round(n_chars / 1e6 / fit_s, 2) if fit_s else 0.0,
+        "query_cold_us": round(min(cold) / nq * 1e6, 2),
+        "query_cached_us": round(min(warm) / nq * 1e6, 2),
+    }
@@ -1,16 +1,33 @@
 from __future__ import annotations
 
+import gc
+import os
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
 
 from diskcache import Cache
 from langchain_core.documents import Document
 
+from rag.admission import Deadline, stage
 from rag.config import settings
-from rag.index import load_bm25, load_vectorstore
+from rag.index import current_version, load_bm25, load_filters, load_vectorstore, read_meta, resolve_index_dir
+from rag.metrics import metrics
+from rag.retrievers.filter_index import FilterExpr
 from rag.retrievers.hybrid_rrf import HybridRetriever
-from rag.utils import normalize_query, sha1_json
-from rag.chains.sop_chain import build_sop_answer
+from rag.retrievers.sharded import ShardedRetriever, load_sharded
+from rag.retrievers.tokenizer import default_tokenize
+from rag.rerankers import get_reranker, rerank
+from rag.utils import highlight_snippet, normalize_query, sha1_json
+from rag.chains.sop_chain import build_sop_answer, extractive_sop
+
+# Backoff cap for the index watcher retrying a version that failed to load.
+_WATCH_RETRY_MAX_SECONDS = 600.0
 
 @dataclass
 class AskResponse:
@@ -19,14 +36,141 @@ class AskResponse:
     sources: List[Dict[str, Any]]
     debug: Dict[str, Any]
 
+@dataclass
+class SearchResponse:
+    sources: List[Dict[str, Any]]
+    debug: Dict[str, Any]
+
+@dataclass
+class IndexHandle:
+    version: str
+    index_dir: str
+    retriever: Union[HybridRetriever, ShardedRetriever]
+    load_seconds: float
+    in_flight: int = 0
+    warmup_seconds: float = 0.0
+
+def load_index(storage_dir: str, version: Optional[str] = None, backend: Optional[str] = None) -> IndexHandle:
+    """`backend` overrides VECTOR_BACKEND, e.g. for an index a tool just built with a fixed backend."""
+    t0 = time.perf_counter()
+    version, index_dir = resolve_index_dir(storage_dir, version)
+    meta = read_meta(index_dir)
+    if meta.get("shards"):
+        retriever = load_sharded(index_dir, meta, version)
+    else:
+        vs = load_vectorstore(index_dir, backend=backend)
+        bm25 = load_bm25(index_dir)
+        retriever = HybridRetriever(vs, bm25, filters=load_filters(index_dir, bm25), backend=backend)
+    return IndexHandle(version=version, index_dir=index_dir, retriever=retriever,
+                       load_seconds=time.perf_counter() - t0)
+
+def warm_index(handle: IndexHandle, batch: int) -> float:
+    """Embed a dummy batch and run one retrieval so the first real query skips lazy model init."""
+    if batch <= 0:
+        return 0.0
+    t0 = time.perf_counter()
+    handle.retriever.embeddings.embed_documents(["warmup"] * batch)
+    handle.retriever.retrieve("warmup", top_k=1, fetch_k=1)
+    handle.warmup_seconds = time.perf_counter() - t0
+    return handle.warmup_seconds
+
 class RAGService:
     def __init__(self, storage_dir: str):
         self.storage_dir = storage_dir
-        self.vs = load_vectorstore(storage_dir)
-        self.bm25 = load_bm25(storage_dir)
-        self.retriever = HybridRetriever(self.vs, self.bm25)
+        self._cond = threading.Condition()
+        self._reload_lock = threading.Lock()
+        self.handle = load_index(storage_dir)
+        self.load_seconds = self.handle.load_seconds
         self.cache = Cache(settings.cache_dir)
         self.ttl = settings.cache_ttl_seconds
+        # Retrieval-only results live in their own tier: smaller, shorter TTL, no LLM output.
+        self.search_cache = Cache(os.path.join(settings.cache_dir, "search"))
+        self.search_ttl = settings.search_cache_ttl_seconds
+        self._watcher: Optional[threading.Thread] = None
+
+    @property
+    def retriever(self) -> Union[HybridRetriever, ShardedRetriever]:
+        return self.handle.retriever
+
+    @property
+    def index_version(self) -> str:
+        return self.handle.version
+
+    @contextmanager
+    def _use_index(self) -> Iterator[IndexHandle]:
+        with self._cond:
+            h = self.handle
+            h.in_flight += 1
+        try:
+            yield h
+        finally:
+            with self._cond:
+                h.in_flight -= 1
+                self._cond.notify_all()
+
+    def warmup(self) -> float:
+        return warm_index(self.handle, settings.warmup_batch)
+
+    def reload(self, version: Optional[str] = None, warm: bool = True) -> Dict[str, Any]:
+        """Load `version` (default: CURRENT), swap it in, then drain and free the old index.
+
+        `warm=False` skips the model warm-up, e.g. in the prefork master, whose workers warm up themselves.
+        """
+        with self._reload_lock:
+            new = load_index(self.storage_dir, version)
+            if warm:
+                warm_index(new, settings.warmup_batch)
+            with self._cond:
+                old, self.handle = self.handle, new
+                drained = self._cond.wait_for(lambda: old.in_flight == 0, timeout=settings.index_drain_seconds)
+            old_version = old.version
+            # Drop our last reference; requests still holding it (if the drain timed out) keep it alive.
+            del old
+            gc.collect()
+            return {"previous": old_version, "current": new.version,
+                    "load_seconds": new.load_seconds, "drained": drained}
+
+    def reload_async(self, version: Optional[str] = None) -> threading.Thread:
+        t = threading.Thread(target=self.reload, args=(version,), name="index-reload", daemon=True)
+        t.start()
+        return t
+
+    def start_watcher(self, interval: float, reload: Optional[Callable[[str], Any]] = None):
+        """Poll the CURRENT pointer and hot-swap whenever build-index publishes a new version.
+
+        `reload` replaces `self.reload` for the swap (the prefork master reloads and then re-forks its workers).
+        """
+        reload = reload or self.reload
+        if self._watcher is not None or interval <= 0:
+            return
+
+        def _loop():
+            failed: Optional[str] = None
+            attempts, retry_at = 0, 0.0
+            while True:
+                time.sleep(interval)
+                v = current_version(self.storage_dir)
+                if v is None or v == self.handle.version:
+                    continue
+                if v == failed and time.monotonic() < retry_at:
+                    continue
+                try:
+                    reload(v)
+                    failed, attempts = None, 0
+                except Exception:
+                    # Keep serving the old version; retry with backoff, since the failure may be
+                    # transient (warm-up against an embedding endpoint or Milvus that is down).
+                    attempts = attempts + 1 if v == failed else 1
+                    failed = v
+                    delay = min(_WATCH_RETRY_MAX_SECONDS, interval * 2 ** attempts)
+                    retry_at = time.monotonic() + delay
+                    print(f"[index-watcher] pid={os.getpid()} failed to load version {v} "
+                          f"(attempt {attempts}, retrying in {delay:g}s):", file=sys.stderr)
+                    traceback.print_exc()
+                    sys.stderr.flush()
+
+        self._watcher = threading.Thread(target=_loop, name="index-watcher", daemon=True)
+        self._watcher.start()
 
     def _docs_to_sources(self, docs: List[Document]) -> List[Dict[str, Any]]:
         out = []
@@ -44,25 +188,33 @@ class RAGService:
             })
         return out
 
-    def ask(self, question: str,
-            components: Optional[List[str]] = None,
-            tags: Optional[List[str]] = None,
-            top_k: Optional[int] = None,
-            fetch_k: Optional[int] = None,
-            debug: bool = True) -> AskResponse:
-
-        q = normalize_query(question)
-        top_k = top_k or settings.top_k
-        fetch_k = fetch_k or settings.fetch_k
-
-        cache_key = sha1_json({"q": q, "components": components, "tags": tags, "k": top_k, "fk": fetch_k})
-        cached = self.cache.get(cache_key, default=None)
-        if cached is not None:
-            return cached
+    def _cache_key(self, version: str, q: str, components, tags, top_k: int, fetch_k: int,
+                   where: Optional[FilterExpr] = None, min_score: Optional[int] = None, debug: bool = False) -> str:
+        # Cached responses carry their debug payload (or {}), so debug is part of the key.
+        return sha1_json({"v": version, "q": q, "components": components, "tags": tags,
+                          "k": top_k, "fk": fetch_k, "where": where, "min_score": min_score, "debug": bool(debug)})
 
-        fused, r_debug = self.retriever.retrieve(q, top_k=top_k, fetch_k=fetch_k, components=components, tags=tags)
+    def _answer(self, q: str, fused: List[Tuple[Document, float]], r_debug: Dict[str, Any],
+                debug: bool, cache_key: str, deadline: Optional[Deadline] = None) -> AskResponse:
         docs = [d for d, _ in fused]
-        sop = build_sop_answer(q, docs)
+        degraded = None
+        t0 = time.perf_counter()
+        remaining = deadline.remaining() if deadline is not None else None
+        if remaining is not None and remaining < settings.llm_min_seconds:
+            # Budget spent upstream (queueing, retrieval): answer from the sources instead of starting the LLM.
+            degraded = "deadline"
+            metrics.inc("llm_skipped_deadline")
+            sop = extractive_sop(q, docs, reason=degraded)
+        else:
+            try:
+                with stage("llm", deadline):
+                    sop = build_sop_answer(q, docs, timeout=remaining)
+            except Exception as e:
+                # Timeouts / gateway errors / LLM stage full: still return the sources, with an extractive answer.
+                degraded = type(e).__name__
+                sop = extractive_sop(q, docs, reason=degraded)
+        if debug:
+            r_debug.setdefault("timings_ms", {})["llm_ms"] = (time.perf_counter() - t0) * 1000
 
         answer_md = (
             f"### 结论摘要\n{sop.get('summary','')}\n\n"
@@ -77,5 +229,153 @@ class RAGService:
             sources=self._docs_to_sources(docs),
             debug=r_debug if debug else {},
         )
-        self.cache.set(cache_key, resp, expire=self.ttl)
+        if degraded is None:
+            self.cache.set(cache_key, resp, expire=self.ttl)
+        else:
+            resp.debug["degraded"] = degraded
         return resp
+
+    def search(self, query: str,
+               components: Optional[List[str]] = None,
+               tags: Optional[List[str]] = None,
+               top_k: Optional[int] = None,
+               fetch_k: Optional[int] = None,
+               use_rerank: bool = False,
+               debug: bool = False,
+               where: Optional[FilterExpr] = None,
+               min_score: Optional[int] = None,
+               deadline: Optional[Deadline] = None) -> SearchResponse:
+        """Retrieval only: fused (optionally reranked) sources with scores and highlights, no LLM."""
+        q = normalize_query(query)
+        top_k = top_k or settings.top_k
+        fetch_k = fetch_k or settings.fetch_k
+        use_rerank = use_rerank and get_reranker() is not None
+
+        with self._use_index() as h:
+            key = self._cache_key(h.version, q, components, tags, top_k, fetch_k, where, min_score, debug)
+            cache_key = sha1_json({"search": 1, "rr": use_rerank, "key": key})
+            cached = self.search_cache.get(cache_key, default=None)
+            if cached is not None:
+                metrics.inc("search_cache_hits")
+                if debug:
+                    cached.debug["cache_hit"] = True
+                return cached
+            metrics.inc("search_cache_misses")
+
+            t0 = time.perf_counter()
+            k = max(top_k, settings.rerank_candidates) if use_rerank else top_k
+            with stage("retrieval", deadline):
+                fused, r_debug = h.retriever.retrieve(q, top_k=k, fetch_k=fetch_k, components=components,
+                                                      tags=tags, debug=debug, where=where,
+                                                      min_score=min_score)
+        timings = {"retrieve_ms": (time.perf_counter() - t0) * 1000}
+
+        if use_rerank and deadline is not None and deadline.remaining() < settings.rerank_min_seconds:
+            use_rerank = False
+            metrics.inc("rerank_skipped_deadline")
+            r_debug["skipped"] = ["rerank"]
+
+        rrf_by_doc = {id(d): s for d, s in fused}
+        rerank_by_doc: Dict[int, float] = {}
+        if use_rerank:
+            t1 = time.perf_counter()
+            ranked = rerank(q, [d for d, _ in fused], top_k)
+            timings["rerank_ms"] = (time.perf_counter() - t1) * 1000
+            rerank_by_doc = {id(d): s for d, s in ranked}
+            docs = [d for d, _ in ranked]
+        else:
+            docs = [d for d, _ in fused]
+
+        terms = default_tokenize(q)
+        sources = self._docs_to_sources(docs)
+        for src, d in zip(sources, docs):
+            src["rrf_score"] = rrf_by_doc.get(id(d))
+            if use_rerank:
+                src["rerank_score"] = rerank_by_doc.get(id(d))
+            src["highlight"] = highlight_snippet(d.page_content, terms)
+
+        r_debug.setdefault("timings_ms", {}).update(timings)
+        r_debug.update({"index_version": h.version, "reranked": use_rerank})
+        resp = SearchResponse(sources=sources, debug=r_debug if debug else {})
+        self.search_cache.set(cache_key, resp, expire=self.search_ttl)
+        return resp
+
+    def ask(self, question: str,
+            components: Optional[List[str]] = None,
+            tags: Optional[List[str]] = None,
+            top_k: Optional[int] = None,
+            fetch_k: Optional[int] = None,
+            debug: bool = True,
+            where: Optional[FilterExpr] = None,
+            min_score: Optional[int] = None,
+            deadline: Optional[Deadline] = None) -> AskResponse:
+        """Cached answer, else retrieve + LLM. With a `deadline`, stages wait for admission only
+        within the budget, and the LLM is skipped (sources-only answer) once too little is left."""
+
+        q = normalize_query(question)
+        top_k = top_k or settings.top_k
+        fetch_k = fetch_k or settings.fetch_k
+
+        with self._use_index() as h:
+            cache_key = self._cache_key(h.version, q, components, tags, top_k, fetch_k, where, min_score, debug)
+            cached = self.cache.get(cache_key, default=None)
+            if cached is not None:
+                metrics.inc("answer_cache_hits")
+                if debug:
+                    cached.debug["cache_hit"] = True
+                return cached
+            metrics.inc("answer_cache_misses")
+
+            with stage("retrieval", deadline):
+                fused, r_debug = h.retriever.retrieve(q, top_k=top_k, fetch_k=fetch_k, components=components,
+                                                      tags=tags, debug=debug, where=where,
+                                                      min_score=min_score)
+        r_debug["index_version"] = h.version
+        return self._answer(q, fused, r_debug, debug, cache_key, deadline)
+
+    def ask_batch(self, questions: Sequence[str],
+                  components: Optional[List[str]] = None,
+                  tags: Optional[List[str]] = None,
+                  top_k: Optional[int] = None,
+                  fetch_k: Optional[int] = None,
+                  debug: bool = False,
+                  concurrency: Optional[int] = None,
+                  where: Optional[FilterExpr] = None,
+                  min_score: Optional[int] = None) -> Iterator[Tuple[Optional[AskResponse], Optional[str]]]:
+        """Answer many questions; yields (response, error) in input order as soon as each is ready.
+
+        Cache misses are retrieved together (one embedding call, one FAISS matrix
+        search, one vectorized BM25 pass); LLM calls run on a bounded thread pool.
+        """
+        qs = [normalize_query(x) for x in questions]
+        top_k = top_k or settings.top_k
+        fetch_k = fetch_k or settings.fetch_k
+
+        with self._use_index() as h:
+            keys = [self._cache_key(h.version, q, components, tags, top_k, fetch_k, where, min_score, debug) for q in qs]
+            cached = [self.cache.get(key, default=None) for key in keys]
+            miss = [i for i, c in enumerate(cached) if c is None]
+            metrics.inc("answer_cache_hits", len(qs) - len(miss))
+            metrics.inc("answer_cache_misses", len(miss))
+            retrieved = []
+            if miss:
+                with stage("retrieval"):
+                    retrieved = h.retriever.retrieve_batch(
+                        [qs[i] for i in miss], top_k=top_k, fetch_k=fetch_k, components=components, tags=tags,
+                        debug=debug, where=where, min_score=min_score,
+                    )
+
+        workers = max(1, concurrency or settings.llm_concurrency)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ask-batch") as pool:
+            futures = {}
+            for i, (fused, r_debug) in zip(miss, retrieved):
+                r_debug["index_version"] = h.version
+                futures[i] = pool.submit(self._answer, qs[i], fused, r_debug, debug, keys[i])
+            for i, c in enumerate(cached):
+                if c is not None:
+                    yield c, None
+                    continue
+                try:
+                    yield futures[i].result(), None
+                except Exception as e:
+                    yield None, f"{type(e).__name__}: {e}"
@@ -1,6 +1,6 @@
 from __future__ import annotations
 import hashlib, json, re
-from typing import Any
+from typing import Any, Iterable
 
 def sha1_json(obj: Any) -> str:
     raw = json.dumps(obj, sort_keys=True, ensure_ascii=False).encode("utf-8")
@@ -10,3 +10,51 @@ def normalize_query(q: str) -> str:
     q = q.strip()
     q = re.sub(r"\s+", " ", q)
     return q
+
+def highlight_snippet(text: str, terms: Iterable[str], width: int = 300) -> str:
+    """Window of `text` around the first query-term hit, with hits wrapped in **...**."""
+    terms = sorted({t for t in terms if len(t) >= 3 or not t.isascii()}, key=len, reverse=True)
+    pattern = re.compile("|".join(re.escape(t) for t in terms), re.IGNORECASE) if terms else None
+    m = pattern.search(text) if pattern else None
+    start = max(0, m.start() - width // 3) if m else 0
+    end = min(len(text), start + width)
+    window = text[start:end]
+    if pattern:
+        window = pattern.sub(lambda x: f"**{x.group(0)}**", window)
+    return ("…" if start > 0 else "") + window + ("…" if end < len(text) else "")
+
+def memory_usage_mb() -> dict:
+    """RSS and private (unshared) memory of the current process, in MB.
+
+    private_mb is what a forked worker does not share with its parent, so it is
+    the number to watch when checking that preloaded indexes stay copy-on-write.
+    """
+    out = {"rss_mb": None, "private_mb": None}
+    try:
+        with open("/proc/self/smaps_rollup", "r") as f:
+            fields = {}
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                    fields[parts[0][:-1]] = int(parts[1])
+        out["rss_mb"] = round(fields.get("Rss", 0) / 1024, 1)
+        out["private_mb"] = round((fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)) / 1024, 1)
+    except OSError:
+        import resource
+        out["rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return out
+
+def import_time(module: str) -> tuple:
+    """(total_ms, {module: cumulative_ms}) for importing `module` in a fresh interpreter (-X importtime)."""
+    import subprocess, sys
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr[-2000:]}")
+    per_module = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        per_module[name.strip()] = int(cumulative) / 1000
+    return per_module.get(module, 0.0), per_module
@@ -1,18 +1,26 @@
 from __future__ import annotations
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, List, Optional
 from langchain_core.documents import Document
 from rag.embeddings import get_embeddings
+from rag.embedding_store import EmbeddingStore
 
-def build_faiss(docs: List[Document], path: str):
+def build_faiss(docs: List[Document], path: str, store: Optional[EmbeddingStore] = None) -> Dict[str, Any]:
     from langchain_community.vectorstores.faiss import FAISS
     embeddings = get_embeddings()
-    vs = FAISS.from_documents(docs, embedding=embeddings)
+    ids = [str(d.metadata["doc_id"]) for d in docs] if docs and "doc_id" in docs[0].metadata else None
+    if store is None:
+        vs = FAISS.from_documents(docs, embedding=embeddings, ids=ids)
+    else:
+        texts = [d.page_content for d in docs]
+        vectors = store.embed(texts, embeddings)
+        vs = FAISS.from_embeddings(zip(texts, vectors), embeddings,
+                                   metadatas=[d.metadata for d in docs], ids=ids)
     Path(path).mkdir(parents=True, exist_ok=True)
     vs.save_local(path)
-    return vs
+    return {"n_vectors": len(docs)}
 
-def load_faiss(path: str):
+def load_faiss(path: str, embeddings=None):
     from langchain_community.vectorstores.faiss import FAISS
-    embeddings = get_embeddings()
+    embeddings = embeddings if embeddings is not None else get_embeddings()
     return FAISS.load_local(path, embeddings, allow_dangerous_deserialization=True)
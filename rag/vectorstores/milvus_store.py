@@ -1,25 +1,298 @@
 from __future__ import annotations
-from typing import List
+
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
 from langchain_core.documents import Document
+
 from rag.config import settings
+from rag.embedding_store import EmbeddingStore
 from rag.embeddings import get_embeddings
+from rag.retrievers.filter_index import FilterError, FilterExpr, filter_node
 
-def build_milvus(docs: List[Document]):
-    from langchain_milvus import Milvus
-    embeddings = get_embeddings()
-    return Milvus.from_documents(
-        docs,
-        embedding=embeddings,
-        collection_name=settings.milvus_collection,
-        connection_args={"uri": settings.milvus_uri},
-        drop_old=True,
-    )
-
-def load_milvus():
-    from langchain_milvus import Milvus
+# Typed columns carry everything retrieval filters on or returns; any other
+# Document.metadata keys go into the `metadata` JSON column, which search does not fetch.
+_OUTPUT_FIELDS = ["text", "qid", "chunk_id", "title", "component", "tags", "score", "accepted"]
+_METRIC = "L2"
+_MAX_TAGS = 16
+# Scalar indexes for pushed-down filters. Older servers and Milvus Lite reject
+# some (e.g. INVERTED on ARRAY); those filters still work, just unindexed.
+_SCALAR_INDEXES = [("component", "INVERTED"), ("tags", "INVERTED"), ("score", "STL_SORT"), ("accepted", "INVERTED")]
+
+def _import_pymilvus():
+    # pymilvus parses $MILVUS_URI at import time and rejects Milvus Lite file paths;
+    # we always pass the uri explicitly, so hide the variable during the first import.
+    saved = os.environ.pop("MILVUS_URI", None)
+    try:
+        import pymilvus
+    finally:
+        if saved is not None:
+            os.environ["MILVUS_URI"] = saved
+    return pymilvus
+
+@lru_cache(maxsize=None)
+def _client(uri: str, pid: int):
+    return _import_pymilvus().MilvusClient(uri=uri)
+
+def get_client(uri: Optional[str] = None):
+    """Process-wide shared MilvusClient (one gRPC channel per process; keyed by pid so forked workers reconnect).
+
+    `uri` may be a server URL or a local file path, which uses Milvus Lite.
+    """
+    return _client(uri or settings.milvus_uri, os.getpid())
+
+def _schema(dim: int):
+    pymilvus = _import_pymilvus()
+    DataType, MilvusClient = pymilvus.DataType, pymilvus.MilvusClient
+    schema = MilvusClient.create_schema(auto_id=False, enable_dynamic_field=False)
+    schema.add_field("doc_id", DataType.INT64, is_primary=True)
+    schema.add_field("vector", DataType.FLOAT_VECTOR, dim=dim)
+    schema.add_field("text", DataType.VARCHAR, max_length=65535)
+    schema.add_field("qid", DataType.INT64)
+    schema.add_field("chunk_id", DataType.INT64)
+    schema.add_field("title", DataType.VARCHAR, max_length=1024)
+    schema.add_field("component", DataType.VARCHAR, max_length=64)
+    schema.add_field("tags", DataType.ARRAY, element_type=DataType.VARCHAR, max_capacity=_MAX_TAGS, max_length=128)
+    schema.add_field("score", DataType.INT64)
+    schema.add_field("accepted", DataType.BOOL)
+    schema.add_field("metadata", DataType.JSON)
+    return schema
+
+def _index_params(client):
+    params = client.prepare_index_params()
+    params.add_index(field_name="vector", index_type="AUTOINDEX", metric_type=_METRIC)
+    return params
+
+def _create_scalar_indexes(client, collection: str) -> List[str]:
+    created = []
+    for field, index_type in _SCALAR_INDEXES:
+        params = client.prepare_index_params()
+        params.add_index(field_name=field, index_type=index_type)
+        try:
+            client.create_index(collection_name=collection, index_params=params)
+            created.append(field)
+        except Exception as e:
+            print(f"[milvus] no {index_type} index on {collection}.{field} (filter runs unindexed): {e}",
+                  file=sys.stderr)
+    return created
+
+def _row(doc: Document, vector: Sequence[float]) -> Dict[str, Any]:
+    md = dict(doc.metadata or {})
+    return {
+        "doc_id": int(md.pop("doc_id")),
+        "vector": list(vector),
+        "text": doc.page_content,
+        "qid": int(md.pop("qid", 0) or 0),
+        "chunk_id": int(md.pop("chunk_id", 0) or 0),
+        "title": str(md.pop("title", "") or "")[:1024],
+        "component": str(md.pop("component", "") or ""),
+        "tags": [str(t).lower()[:128] for t in (md.pop("tags", None) or [])][:_MAX_TAGS],
+        "score": int(md.pop("score", 0) or 0),
+        "accepted": bool(md.pop("accepted", False)),
+        "metadata": md,
+    }
+
+def _to_document(hit: Dict[str, Any], has_doc_id: bool) -> Tuple[Document, float]:
+    ent = dict(hit.get("entity", {}))
+    text = ent.pop("text", "")
+    md = dict(ent.pop("metadata", None) or {})  # collections built before typed columns
+    md.update(ent)
+    if has_doc_id:
+        md["doc_id"] = hit.get("doc_id", hit.get("id"))
+    else:
+        # Legacy (langchain-milvus) schema: its primary key is not a BM25 row, so callers match by key.
+        md.pop("doc_id", None)
+    return Document(page_content=text, metadata=md), float(hit["distance"])
+
+def milvus_filter_expr(expr: Optional[FilterExpr], fields: Set[str]) -> Optional[str]:
+    """Translate a FilterIndex expression into a Milvus boolean expression.
+
+    Raises FilterError for malformed expressions and for leaves the collection has no column for.
+    """
+    if expr is None:
+        return None
+    op, arg = filter_node(expr)
+    if op in ("component", "tag"):
+        field = "component" if op == "component" else "tags"
+        if field not in fields:
+            raise FilterError(f"collection has no '{field}' field")
+        names = json.dumps(arg if op == "component" else [x.lower() for x in arg], ensure_ascii=False)
+        return f"component in {names}" if op == "component" else f"ARRAY_CONTAINS_ANY(tags, {names})"
+    if op == "min_score":
+        if "score" not in fields:
+            raise FilterError("collection has no 'score' field")
+        return f"score >= {arg}"
+    if op == "not":
+        return f"not ({milvus_filter_expr(arg, fields)})"
+    return f" {op} ".join(f"({milvus_filter_expr(sub, fields)})" for sub in arg)
+
+def _fingerprint(docs: List[Document], batch_size: int) -> str:
+    h = hashlib.sha1(f"{settings.embedding_model}|{batch_size}|{len(docs)}".encode("utf-8"))
+    for d in docs:
+        h.update(d.page_content.encode("utf-8"))
+    return h.hexdigest()
+
+class _IngestState:
+    """Ingestion progress persisted next to the index so a failed build can resume."""
+
+    def __init__(self, path: Path, fingerprint: str):
+        self.path = path
+        self._lock = threading.Lock()
+        data: Dict[str, Any] = {}
+        if path.exists():
+            data = json.loads(path.read_text(encoding="utf-8"))
+        if data.get("fingerprint") != fingerprint:
+            data = {"fingerprint": fingerprint, "collection": None, "done": []}
+        self.data = data
+
+    @property
+    def done(self) -> set:
+        return set(self.data["done"])
+
+    def mark(self, batch: int):
+        with self._lock:
+            self.data["done"].append(batch)
+            self.save()
+
+    def save(self):
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.data), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        self.path.unlink(missing_ok=True)
+
+def _upsert_with_retry(client, collection: str, rows: List[Dict[str, Any]], retries: int):
+    # Upsert on doc_id: a batch inserted before a crash but not yet marked done is rewritten, not duplicated.
+    for attempt in range(retries + 1):
+        try:
+            client.upsert(collection_name=collection, data=rows)
+            return
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(min(30.0, 0.5 * 2 ** attempt))
+
+def drop_collection(collection: str):
+    client = get_client()
+    if collection in client.list_collections():
+        client.drop_collection(collection)
+
+def build_milvus(docs: List[Document], state_dir: str, store: Optional[EmbeddingStore] = None) -> Dict[str, Any]:
+    """Embed and insert `docs` into a fresh collection `<MILVUS_COLLECTION>__<timestamp>` in batches.
+
+    The collection name is recorded in the index version's meta.json; services only
+    search it once they load that version, so the switch follows CURRENT. Progress is
+    checkpointed per batch in `state_dir`; rerunning the same build after a failure
+    skips the batches already inserted.
+    """
+    client = get_client()
     embeddings = get_embeddings()
-    return Milvus(
-        embedding_function=embeddings,
-        collection_name=settings.milvus_collection,
-        connection_args={"uri": settings.milvus_uri},
-    )
+    prefix = settings.milvus_collection
+    batch_size = max(1, settings.milvus_insert_batch)
+    state = _IngestState(Path(state_dir) / "milvus_ingest.json", _fingerprint(docs, batch_size))
+
+    collection = state.data.get("collection")
+    if not collection or collection not in client.list_collections():
+        collection = f"{prefix}__{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        dim = len(embeddings.embed_query("dimension probe"))
+        client.create_collection(collection_name=collection, schema=_schema(dim), index_params=_index_params(client))
+        state.data.update({"collection": collection, "done": []})
+        state.save()
+
+    batches = [(b, docs[s:s + batch_size]) for b, s in enumerate(range(0, len(docs), batch_size))]
+    done = state.done
+    pending = [(b, part) for b, part in batches if b not in done]
+
+    def _work(b: int, part: List[Document]) -> int:
+        texts = [d.page_content for d in part]
+        vectors = store.embed(texts, embeddings) if store is not None else embeddings.embed_documents(texts)
+        _upsert_with_retry(client, collection, [_row(d, v) for d, v in zip(part, vectors)],
+                           settings.milvus_insert_retries)
+        state.mark(b)
+        return len(part)
+
+    inserted, errors = 0, []
+    with ThreadPoolExecutor(max_workers=max(1, settings.milvus_insert_workers)) as pool:
+        futures = [pool.submit(_work, b, part) for b, part in pending]
+        for f in as_completed(futures):
+            try:
+                inserted += f.result()
+            except Exception as e:
+                errors.append(e)
+    if errors:
+        raise RuntimeError(f"{len(errors)}/{len(pending)} Milvus insert batches failed "
+                           f"(progress saved, rerun to resume): {errors[0]}")
+
+    client.flush(collection_name=collection)
+    scalar_indexes = _create_scalar_indexes(client, collection)
+    client.load_collection(collection_name=collection)
+    state.clear()
+    return {"collection": collection, "batches": len(batches), "resumed_batches": len(batches) - len(pending), "inserted": inserted,
+            "scalar_indexes": scalar_indexes}
+
+class MilvusVectorStore:
+    """Minimal search-side wrapper over the shared MilvusClient, bound to one collection."""
+
+    def __init__(self, uri: str, collection: str, embeddings):
+        self.uri = uri
+        self.collection = collection
+        self.embeddings = embeddings
+        client = self.client
+        # No-op when already loaded; an older version being rolled back to may have been released.
+        client.load_collection(collection_name=collection)
+        desc = client.describe_collection(collection_name=collection)
+        self.fields: Set[str] = {f["name"] for f in desc.get("fields", [])}
+        if "doc_id" in self.fields:
+            self.output_fields = [f for f in _OUTPUT_FIELDS if f in self.fields]
+            if "tags" not in self.fields:
+                self.output_fields.append("metadata")
+        else:
+            # Legacy langchain-milvus collection: metadata sits in its own columns, a `metadata`
+            # JSON column or dynamic fields, so fetch every scalar field.
+            self.output_fields = [f["name"] for f in desc.get("fields", [])
+                                  if not f.get("is_primary") and "VECTOR" not in getattr(f["type"], "name", str(f["type"]))]
+            if desc.get("enable_dynamic_field"):
+                self.output_fields.append("$meta")
+
+    @property
+    def client(self):
+        # Resolved per call: a store loaded before prefork must not reuse the master's gRPC channel.
+        return get_client(self.uri)
+
+    def similarity_search_with_score_by_vectors(
+        self, vectors: Sequence[Sequence[float]], k: int, expr: Optional[str] = None
+    ) -> List[List[Tuple[Document, float]]]:
+        res = self.client.search(
+            collection_name=self.collection,
+            data=[list(v) for v in vectors],
+            limit=k,
+            filter=expr or "",
+            output_fields=self.output_fields,
+            search_params={"metric_type": _METRIC},
+        )
+        has_doc_id = "doc_id" in self.fields
+        return [[_to_document(hit, has_doc_id) for hit in hits] for hits in res]
+
+    def similarity_search_with_score_by_vector(
+        self, embedding: Sequence[float], k: int = 4, expr: Optional[str] = None, **kwargs
+    ) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vectors([embedding], k, expr)[0]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, expr: Optional[str] = None, **kwargs
+    ) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self.embeddings.embed_query(query), k, expr)
+
+def load_milvus(collection: Optional[str] = None):
+    """`collection` comes from the index version's meta.json; MILVUS_COLLECTION serves indexes that predate it."""
+    return MilvusVectorStore(settings.milvus_uri, collection or settings.milvus_collection, get_embeddings())
@@ -1,11 +1,13 @@
 from __future__ import annotations
 
-import typer
-import uvicorn
+import os
+import subprocess
+import sys
+import time
 
-from rag.data.build_dataset import build_dataset_from_posts_xml
-from rag.index import build_all
+import typer
 
+# Subcommands import what they need; `import scripts.cli` must stay cheap (see `import-budget`).
 cli = typer.Typer(help="Data Platform RAG Assistant CLI")
 
 @cli.command("build-dataset")
@@ -16,6 +18,7 @@ def build_dataset(
     max_questions: int = typer.Option(200000, help="Max questions to scan"),
     min_score: int = typer.Option(-5, help="Min score threshold"),
 ):
+    from rag.data.build_dataset import build_dataset_from_posts_xml
     n = build_dataset_from_posts_xml(posts, out, components=components, max_questions=max_questions, min_score=min_score)
     typer.echo(f"Wrote {n} QA records to {out}")
 
@@ -51,17 +54,273 @@ def build_index(
     storage: str = typer.Option("storage", help="Storage directory"),
     chunk_size: int = typer.Option(900, help="Chunk size"),
     chunk_overlap: int = typer.Option(150, help="Chunk overlap"),
+    shard_by: str = typer.Option(None, help="component|hash: write one sub-index per shard (faiss only)"),
+    shards: int = typer.Option(4, help="Shard count for --shard-by hash"),
+    dedup: bool = typer.Option(False, help="Merge near-duplicate records (MinHash LSH) before chunking"),
+    dedup_threshold: float = typer.Option(0.8, help="Estimated Jaccard needed to merge two records"),
 ):
-    meta = build_all(data, backend=backend.lower(), storage_dir=storage, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    from rag.index import build_all
+    dedup_cfg = None
+    if dedup:
+        from rag.data.dedup import DedupConfig
+        dedup_cfg = DedupConfig(threshold=dedup_threshold)
+    meta = build_all(data, backend=backend.lower(), storage_dir=storage, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                     shard_by=shard_by.lower() if shard_by else None, n_shards=shards, dedup=dedup_cfg)
     typer.echo("Index build done.")
     typer.echo(meta)
 
+def _dedup_config(threshold: float, num_perm: int, bands: int, shingle: int, cross_component: bool):
+    from rag.data.dedup import DedupConfig
+    return DedupConfig(num_perm=num_perm, bands=bands, shingle=shingle, threshold=threshold,
+                       same_component=not cross_component)
+
+@cli.command("dedup-dataset")
+def dedup_dataset(
+    in_path: str = typer.Option(..., "--in", help="Processed JSONL (build-dataset / build-dataset-csv output)"),
+    out: str = typer.Option(..., help="Output JSONL with one record per near-duplicate cluster"),
+    threshold: float = typer.Option(0.8, help="Estimated Jaccard needed to merge two records"),
+    num_perm: int = typer.Option(128, help="MinHash permutations"),
+    bands: int = typer.Option(32, help="LSH bands (num_perm must be a multiple)"),
+    shingle: int = typer.Option(3, help="Word n-gram size"),
+    cross_component: bool = typer.Option(False, help="Also merge records of different components"),
+):
+    """Keep the accepted / best-scored record of each near-duplicate cluster (merged qids in merged_qids)."""
+    import json
+    from rag.data.dedup import dedup_jsonl
+    report = dedup_jsonl(in_path, out, _dedup_config(threshold, num_perm, bands, shingle, cross_component))
+    typer.echo(json.dumps(report, ensure_ascii=False, indent=2))
+
+@cli.command("eval-dedup")
+def eval_dedup(
+    data: str = typer.Option(..., help="Processed JSONL before dedup"),
+    storage: str = typer.Option("storage/dedup-eval", help="Scratch storage for the two index builds"),
+    n_queries: int = typer.Option(500, help="Record titles sampled as queries"),
+    top_k: int = typer.Option(8, help="Top k after fusion"),
+    threshold: float = typer.Option(0.8, help="Estimated Jaccard needed to merge two records"),
+    num_perm: int = typer.Option(128, help="MinHash permutations"),
+    bands: int = typer.Option(32, help="LSH bands (num_perm must be a multiple)"),
+    shingle: int = typer.Option(3, help="Word n-gram size"),
+    cross_component: bool = typer.Option(False, help="Also merge records of different components"),
+    seed: int = typer.Option(0, help="Query sampling seed"),
+    out: str = typer.Option(None, help="Write the JSON report here"),
+):
+    """Corpus reduction and retrieval quality (hit@k, MRR, distinct records in top-k) with vs. without dedup."""
+    import json
+    from rag.data.dedup import evaluate
+    report = evaluate(data, storage, _dedup_config(threshold, num_perm, bands, shingle, cross_component),
+                      n_queries=n_queries, top_k=top_k, seed=seed)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    typer.echo(text)
+    if out:
+        with open(out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+@cli.command("bench-tokenize")
+def bench_tokenize(
+    data: str = typer.Option(..., help="Processed JSONL"),
+    cjk_ngram: list[int] = typer.Option([0, 2], help="CJK n-gram sizes to compare (0 = whole runs)"),
+    n_queries: int = typer.Option(2000, help="Queries sampled from record titles"),
+    rounds: int = typer.Option(3, help="Query rounds (best is reported)"),
+):
+    from rag.data.documents import build_documents
+    from rag.retrievers.tokenizer import benchmark
+    docs = build_documents(data)
+    texts = [d.page_content for d in docs]
+    queries = [str(d.metadata.get("title") or d.page_content[:80]) for d in docs[:n_queries]]
+    for n in cjk_ngram:
+        typer.echo({"cjk_ngram": n, **benchmark(texts, queries, n, rounds=rounds)})
+
+@cli.command("ask-batch")
+def ask_batch(
+    in_path: str = typer.Option(..., "--in", help="Input JSONL (request_id + question, or request_id/title/body)"),
+    out: str = typer.Option(..., help="Output JSONL; existing answers are kept and skipped (resume)"),
+    storage: str = typer.Option("storage", help="Storage directory"),
+    components: list[str] = typer.Option(None, help="Filter by component"),
+    tags: list[str] = typer.Option(None, help="Filter by tag"),
+    min_score: int = typer.Option(None, help="Only records with score >= min-score"),
+    top_k: int = typer.Option(None, help="Top k after fusion"),
+    batch_size: int = typer.Option(64, help="Questions retrieved together per batch"),
+    concurrency: int = typer.Option(None, help="Parallel LLM calls (default LLM_CONCURRENCY)"),
+    debug: bool = typer.Option(False, help="Include retrieval debug in output"),
+):
+    from rag.batch import run_batch_file
+    from rag.service import RAGService
+    svc = RAGService(storage)
+
+    def _failed(rid: str, err: str):
+        typer.echo(f"[ask-batch] {rid} failed: {err}", err=True)
+
+    stats = run_batch_file(svc, in_path, out, batch_size=batch_size, components=components or None,
+                           tags=tags or None, min_score=min_score, top_k=top_k, concurrency=concurrency,
+                           debug=debug, on_error=_failed)
+    typer.echo(f"ask-batch done: {stats}")
+
 @cli.command("serve")
 def serve(
     host: str = typer.Option("127.0.0.1", help="Host"),
     port: int = typer.Option(8000, help="Port"),
+    workers: int = typer.Option(1, help="Worker processes; >1 preloads indexes once and forks (copy-on-write)"),
 ):
+    if workers > 1:
+        from app.prefork import run_prefork
+        run_prefork(host, port, workers)
+        return
+    import uvicorn
     uvicorn.run("app.main:app", host=host, port=port, reload=False)
 
+@cli.command("shard-serve")
+def shard_serve(
+    shard: str = typer.Option(..., help="Shard name (see shards in the index meta.json)"),
+    storage: str = typer.Option("storage", help="Storage directory"),
+    version: str = typer.Option(None, help="Pin an index version (default: follow CURRENT)"),
+    watch_seconds: float = typer.Option(10.0, help="CURRENT polling interval; 0 loads new versions on demand only"),
+    host: str = typer.Option("127.0.0.1", help="Host"),
+    port: int = typer.Option(8101, help="Port"),
+):
+    """Serve one shard of a sharded index to routers that list it in SHARD_URLS."""
+    import uvicorn
+    from app.shard import create_app
+    uvicorn.run(create_app(storage, shard, version, watch_seconds), host=host, port=port)
+
+def _mock_config(llm_latency_ms: float, llm_tokens_per_s: float, llm_output_tokens: int,
+                 llm_error_rate: float, embed_latency_ms: float, seed: int):
+    from rag.mock_openai import MockConfig
+    return MockConfig(llm_latency_ms=llm_latency_ms, llm_tokens_per_s=llm_tokens_per_s,
+                      llm_output_tokens=llm_output_tokens, error_rate=llm_error_rate,
+                      embed_latency_ms=embed_latency_ms, seed=seed)
+
+@cli.command("mock-openai")
+def mock_openai(
+    host: str = typer.Option("127.0.0.1", help="Host"),
+    port: int = typer.Option(8900, help="Port"),
+    llm_latency_ms: float = typer.Option(300.0, help="Chat time to first token"),
+    llm_tokens_per_s: float = typer.Option(200.0, help="Chat generation speed"),
+    llm_output_tokens: int = typer.Option(150, help="Tokens per chat answer"),
+    llm_error_rate: float = typer.Option(0.0, help="Fraction of chat calls failing with HTTP 500"),
+    embed_latency_ms: float = typer.Option(5.0, help="Per embeddings request"),
+    seed: int = typer.Option(0, help="Jitter / error RNG seed"),
+):
+    """OpenAI-compatible mock (chat + embeddings); point OPENAI_BASE_URL at it."""
+    from rag.mock_openai import start_mock_server
+    server = start_mock_server(host, port, _mock_config(llm_latency_ms, llm_tokens_per_s, llm_output_tokens,
+                                                        llm_error_rate, embed_latency_ms, seed))
+    typer.echo(f"mock OpenAI API at {server.base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+@cli.command("loadtest")
+def loadtest(
+    url: str = typer.Option(None, help="Target an already running server instead of starting one"),
+    storage: str = typer.Option(None, help="Existing index storage for the started server (default STORAGE_DIR)"),
+    data: str = typer.Option(None, help="Processed JSONL; with --embeddings mock, builds a throwaway index "
+                                        "in a temp dir"),
+    embeddings: str = typer.Option("local", help="local (EMBEDDING_MODEL) | mock (mock server embeddings)"),
+    workers: int = typer.Option(1, help="Server worker processes (/metrics is per worker)"),
+    port: int = typer.Option(8765, help="Port of the started server"),
+    endpoint: str = typer.Option("/ask", help="/ask | /search"),
+    rps: float = typer.Option(0.0, help="Open-loop target RPS (Poisson arrivals); 0 = closed loop"),
+    concurrency: int = typer.Option(8, help="Closed-loop concurrent clients"),
+    duration: float = typer.Option(30.0, help="Seconds to generate load"),
+    requests: int = typer.Option(0, help="Stop after N requests (0 = duration only)"),
+    queries: str = typer.Option(None, help="Replay queries from JSONL / text file (default: synthesized)"),
+    n_queries: int = typer.Option(200, help="Synthesized query pool size"),
+    repeat_ratio: float = typer.Option(0.2, help="Fraction of requests repeating an earlier query"),
+    seed: int = typer.Option(0, help="RNG seed for queries, arrivals and mock latency"),
+    llm_latency_ms: float = typer.Option(300.0, help="Mock chat time to first token"),
+    llm_tokens_per_s: float = typer.Option(200.0, help="Mock chat generation speed"),
+    llm_output_tokens: int = typer.Option(150, help="Mock tokens per chat answer"),
+    llm_error_rate: float = typer.Option(0.0, help="Fraction of mock chat calls failing"),
+    embed_latency_ms: float = typer.Option(5.0, help="Mock embeddings latency per request"),
+    out: str = typer.Option(None, help="Write the JSON report here"),
+):
+    """Offline capacity benchmark: mock OpenAI upstream, real app, synthetic or replayed traffic."""
+    import json
+    import shutil
+    import tempfile
+    from rag.config import settings
+    from rag.loadtest import (LoadConfig, load_queries, query_stream, run_loadtest, spawn_server,
+                              synthesize_queries, wait_ready)
+    from rag.mock_openai import start_mock_server
+
+    if embeddings not in ("local", "mock"):
+        raise typer.BadParameter("--embeddings must be local or mock")
+    if data and embeddings != "mock":
+        raise typer.BadParameter("--data builds a mock-embedding index and needs --embeddings mock")
+    if data and storage:
+        raise typer.BadParameter("--data builds its own throwaway index; drop --storage")
+    if embeddings == "mock" and not data and url is None:
+        # An existing index was embedded with EMBEDDING_MODEL; mock query vectors would not match it.
+        raise typer.BadParameter("--embeddings mock needs --data to build a mock-embedding index")
+
+    pool = load_queries(queries) if queries else synthesize_queries(n_queries, seed)
+    cfg = LoadConfig(endpoint=endpoint, rps=rps, concurrency=concurrency, duration_s=duration,
+                     max_requests=requests, repeat_ratio=repeat_ratio, seed=seed)
+    mock = start_mock_server(config=_mock_config(llm_latency_ms, llm_tokens_per_s, llm_output_tokens,
+                                                 llm_error_rate, embed_latency_ms, seed))
+    proc = None
+    scratch = []
+    try:
+        if url is None:
+            cache_dir = tempfile.mkdtemp(prefix="rag-loadtest-cache-")
+            scratch.append(cache_dir)
+            if data:
+                # Never the serving storage: publishing a mock-embedding version there would be hot-swapped
+                # into live workers and could prune real versions.
+                storage = tempfile.mkdtemp(prefix="rag-loadtest-index-")
+                scratch.append(storage)
+            env = {"OPENAI_BASE_URL": mock.base_url, "OPENAI_API_KEY": "mock",
+                   "STORAGE_DIR": storage or settings.storage_dir, "CACHE_DIR": cache_dir,
+                   "INDEX_WATCH_SECONDS": "0"}
+            if embeddings == "mock":
+                env.update({"EMBEDDING_PROVIDER": "openai", "EMBEDDING_MODEL": "mock-embedding"})
+                subprocess.run([sys.executable, "-m", "scripts.cli", "build-index", "--data", data,
+                                "--storage", storage], env={**os.environ, **env}, check=True)
+            url = f"http://127.0.0.1:{port}"
+            proc = spawn_server(port, workers, env)
+            wait_ready(url, timeout_s=600, proc=proc)
+        typer.echo(f"load: {endpoint} on {url}, upstream mock {mock.base_url}")
+        report = run_loadtest(url, query_stream(pool, repeat_ratio, seed), cfg)
+        report["mock_upstream"] = dict(mock.counts)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=30)
+        mock.shutdown()
+        for path in scratch:
+            shutil.rmtree(path, ignore_errors=True)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    typer.echo(text)
+    if out:
+        with open(out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+@cli.command("import-budget")
+def import_budget(
+    check: list[str] = typer.Option(["scripts.cli=150", "app.main=800"],
+                                    help="module=max_ms, imported in a fresh interpreter"),
+    forbid: list[str] = typer.Option(["uvicorn", "lxml", "bs4", "tqdm", "faiss", "torch", "sentence_transformers",
+                                      "langchain_core", "langchain_community", "langchain_text_splitters"],
+                                     help="Top-level packages that must not be imported"),
+    top: int = typer.Option(10, help="Show the N slowest imports"),
+):
+    """Measure import cost with `python -X importtime`; exits 1 when over budget."""
+    from rag.utils import import_time
+    failed = False
+    for item in check:
+        module, _, budget = item.partition("=")
+        budget_ms = float(budget or "inf")
+        total_ms, per_module = import_time(module)
+        bad = sorted({name.split(".")[0] for name in per_module} & set(forbid))
+        over = total_ms > budget_ms
+        failed = failed or over or bool(bad)
+        typer.echo(f"{module}: {total_ms:.0f} ms (budget {budget_ms:.0f}){' OVER' if over else ''}"
+                   + (f", forbidden: {', '.join(bad)}" if bad else ""))
+        for name, ms in sorted(per_module.items(), key=lambda x: x[1], reverse=True)[:top]:
+            typer.echo(f"  {ms:8.1f} ms  {name}")
+    raise typer.Exit(1 if failed else 0)
+
 if __name__ == "__main__":
     cli()